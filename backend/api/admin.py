@@ -1,28 +1,188 @@
-  
 import os
 from flask_admin import Admin
 from .models import db, User, Ingredient, Chat, ChatParticipant, Cocktail, Comment, Dish, Favorite, Pairing, Post, Message, Notification, Follow
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import literal, or_, text
+from sqlalchemy.orm import defer
 
-def setup_admin(app):
+# below this many rows (as estimated by Postgres) the list pages count them exactly
+EXACT_COUNT_BELOW = 100000
+MAX_PAGE_SIZE = 100
+# OFFSET reads every skipped row, deeper pages need a filter
+MAX_OFFSET = 100000
+TRUNCATE_AT = 80
+
+
+def truncated(name):
+    def formatter(view, context, model, name=name):
+        value = getattr(model, name)
+        if value is not None and len(value) > TRUNCATE_AT:
+            return value[:TRUNCATE_AT] + "…"
+        return value
+    return formatter
+
+
+def user_ajax_ref():
+    # the forms would otherwise load every user into a select
+    return {'fields': ['username', 'email'], 'page_size': 10}
+
+
+class ScalableModelView(ModelView):
+    """
+    List pages that stay fast on tables of millions of rows: bounded pages, estimated
+    counts on Postgres when nothing is searched or filtered, exact-match search so the
+    indexes are used, sorting only on indexed columns, and columns_not_listed deferred
+    so their text is never read.
+    """
+    page_size = 50
+    can_set_page_size = True
+    column_default_sort = ('id', True)
+    column_sortable_list = ('id',)
+    columns_not_listed = ()
+
+    def _get_list_extra_args(self):
+        view_args = super()._get_list_extra_args()
+        view_args.page_size = min(view_args.page_size or self.page_size, MAX_PAGE_SIZE)
+        view_args.page = max(0, min(view_args.page, MAX_OFFSET // view_args.page_size))
+        return view_args
+
+    def get_query(self):
+        query = super().get_query()
+        for name in self.columns_not_listed:
+            query = query.options(defer(getattr(self.model, name)))
+        return query
+
+    def estimated_count(self):
+        """Postgres' estimate of the rows of the table, None when it's small or unknown."""
+        if self.session.get_bind().dialect.name != "postgresql":
+            return None
+        estimate = self.session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"),
+            {"table": self.model.__tablename__},
+        ).scalar()
+        # -1 before the first ANALYZE
+        if estimate is None or estimate < EXACT_COUNT_BELOW:
+            return None
+        return estimate
+
+    def get_count_query(self):
+        view_args = self._get_list_extra_args()
+        if not view_args.search and not view_args.filters:
+            estimate = self.estimated_count()
+            if estimate is not None:
+                return self.session.query(literal(estimate))
+        return super().get_count_query()
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        # exact matches, ILIKE '%term%' can't use an index
+        term = search.strip()
+        conditions = [field == term for field, path in self._search_fields if not path]
+        query = query.filter(or_(*conditions))
+        if count_query is not None:
+            count_query = count_query.filter(or_(*conditions))
+        return query, count_query, joins, count_joins
+
+
+class UserView(ScalableModelView):
+    column_exclude_list = ('password', 'profile_info')
+    columns_not_listed = ('password', 'profile_info')
+    column_searchable_list = ('username', 'email')
+    column_sortable_list = ('id', 'username', 'email', 'registration_date', 'deleted_at')
+    column_filters = ('registration_date', 'deleted_at')
+
+
+class IngredientView(ScalableModelView):
+    # no filter on type: with two values an index wouldn't spare the scan
+    column_searchable_list = ('name',)
+    column_sortable_list = ('id', 'name')
+
+
+class RecipeView(ScalableModelView):
+    column_list = ('id', 'name', 'flavor_profile', 'user', 'creation_date')
+    columns_not_listed = ('preparation_steps',)
+    column_sortable_list = ('id', 'creation_date')
+    column_filters = ('user_id', 'creation_date')
+    form_ajax_refs = {'user': user_ajax_ref()}
+
+
+class SavedView(ScalableModelView):
+    column_list = ('id', 'user', 'cocktail', 'dish', 'saved_date')
+    column_sortable_list = ('id', 'saved_date')
+    column_filters = ('user_id', 'cocktail_id', 'dish_id', 'saved_date')
+    form_ajax_refs = {
+        'user': user_ajax_ref(),
+        'cocktail': {'fields': ['name'], 'page_size': 10},
+        'dish': {'fields': ['name'], 'page_size': 10},
+    }
+
+
+class PostView(ScalableModelView):
+    column_list = ('id', 'user', 'content', 'creation_date')
+    column_formatters = {'content': truncated('content')}
+    column_filters = ('user_id',)
+    form_ajax_refs = {'user': user_ajax_ref()}
+
+
+class CommentView(ScalableModelView):
+    column_list = ('id', 'post_id', 'user', 'content', 'creation_date')
+    column_formatters = {'content': truncated('content')}
+    column_filters = ('post_id', 'user_id')
+    form_ajax_refs = {'user': user_ajax_ref(), 'post': {'fields': ['id'], 'page_size': 10}}
+
+
+class ChatParticipantView(ScalableModelView):
+    column_list = ('chat', 'user')
+    column_default_sort = ('chat_id', True)
+    column_sortable_list = ()
+    column_filters = ('chat_id', 'user_id')
+    form_ajax_refs = {'user': user_ajax_ref(), 'chat': {'fields': ['name'], 'page_size': 10}}
+
+
+class MessageView(ScalableModelView):
+    column_list = ('id', 'chat', 'user', 'content', 'sent_date')
+    column_sortable_list = ('id', 'sent_date')
+    column_formatters = {'content': truncated('content')}
+    column_filters = ('chat_id', 'user_id', 'sent_date')
+    form_ajax_refs = {'user': user_ajax_ref(), 'chat': {'fields': ['name'], 'page_size': 10}}
+
+
+class NotificationView(ScalableModelView):
+    column_list = ('id', 'user', 'type', 'content', 'read', 'date')
+    column_sortable_list = ('id', 'date')
+    column_formatters = {'content': truncated('content')}
+    column_filters = ('user_id', 'date')
+    form_ajax_refs = {'user': user_ajax_ref()}
+
+
+class FollowView(ScalableModelView):
+    column_list = ('follower', 'followed', 'date')
+    column_default_sort = ('follower_id', True)
+    column_sortable_list = ()
+    column_filters = ('follower_id', 'followed_id')
+    form_ajax_refs = {'follower': user_ajax_ref(), 'followed': user_ajax_ref()}
+
+
+def setup_admin(app, session=None):
+    # the lazily loaded admin passes a session on the main app's engine
+    session = session or db.session
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
-    
+
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Ingredient, db.session))
-    admin.add_view(ModelView(Cocktail, db.session))
-    admin.add_view(ModelView(Dish, db.session))
-    admin.add_view(ModelView(Favorite, db.session))
-    admin.add_view(ModelView(Pairing, db.session))
-    admin.add_view(ModelView(Post, db.session))
-    admin.add_view(ModelView(Comment, db.session))
-    admin.add_view(ModelView(Chat, db.session))
-    admin.add_view(ModelView(ChatParticipant, db.session))
-    admin.add_view(ModelView(Message, db.session))
-    admin.add_view(ModelView(Notification, db.session))
-    admin.add_view(ModelView(Follow, db.session))
+    admin.add_view(UserView(User, session))
+    admin.add_view(IngredientView(Ingredient, session))
+    admin.add_view(RecipeView(Cocktail, session))
+    admin.add_view(RecipeView(Dish, session))
+    admin.add_view(SavedView(Favorite, session))
+    admin.add_view(SavedView(Pairing, session))
+    admin.add_view(PostView(Post, session))
+    admin.add_view(CommentView(Comment, session))
+    admin.add_view(ScalableModelView(Chat, session))
+    admin.add_view(ChatParticipantView(ChatParticipant, session))
+    admin.add_view(MessageView(Message, session))
+    admin.add_view(NotificationView(Notification, session))
+    admin.add_view(FollowView(Follow, session))
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ScalableModelView(YourModelName, session))
@@ -0,0 +1,266 @@
+"""
+Columnar export of pairings, favorites, cocktails and dishes for the data team.
+
+Rows are read in keyset-paginated chunks ordered by (date, id), so memory stays bounded
+by the chunk size whatever the size of the tables. `flask export-analytics` writes them
+as Parquet or Arrow IPC files partitioned by day, and remembers the last exported
+(date, id) of every table: the next run only reads the newer rows. The admin endpoint
+/api/analytics/<table> streams the same chunks as an Arrow IPC stream.
+
+pyarrow is only needed to export, it is imported when it is used.
+"""
+import io
+import json
+import os
+import uuid
+from datetime import datetime
+
+from flask import Blueprint, Response, request, stream_with_context
+from sqlalchemy import and_, or_, select
+
+from api.models import db, Cocktail, Dish, Favorite, Pairing
+from api.utils import APIException, admin_required
+
+analytics = Blueprint('analytics', __name__)
+
+WATERMARKS_FILE = "_watermarks.json"
+
+
+def _saved_rows(model):
+    return (
+        select(
+            model.id, model.user_id,
+            model.cocktail_id, Cocktail.name.label("cocktail_name"), Cocktail.flavor_profile.label("cocktail_flavor"),
+            model.dish_id, Dish.name.label("dish_name"), Dish.flavor_profile.label("dish_flavor"),
+            model.saved_date,
+        )
+        .outerjoin(Cocktail, model.cocktail_id == Cocktail.id)
+        .outerjoin(Dish, model.dish_id == Dish.id),
+        model.saved_date,
+        model.id,
+    )
+
+
+def _recipes(model):
+    return (
+        select(model.id, model.name, model.flavor_profile, model.user_id, model.creation_date),
+        model.creation_date,
+        model.id,
+    )
+
+
+# table -> (query, date column, id column) and the type of every column of the query
+EXPORTS = {
+    "pairings": (lambda: _saved_rows(Pairing), {
+        "id": "int", "user_id": "int", "cocktail_id": "int", "cocktail_name": "string", "cocktail_flavor": "string",
+        "dish_id": "int", "dish_name": "string", "dish_flavor": "string", "saved_date": "timestamp",
+    }),
+    "favorites": (lambda: _saved_rows(Favorite), {
+        "id": "int", "user_id": "int", "cocktail_id": "int", "cocktail_name": "string", "cocktail_flavor": "string",
+        "dish_id": "int", "dish_name": "string", "dish_flavor": "string", "saved_date": "timestamp",
+    }),
+    "cocktails": (lambda: _recipes(Cocktail), {
+        "id": "int", "name": "string", "flavor_profile": "string", "user_id": "int", "creation_date": "timestamp",
+    }),
+    "dishes": (lambda: _recipes(Dish), {
+        "id": "int", "name": "string", "flavor_profile": "string", "user_id": "int", "creation_date": "timestamp",
+    }),
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise APIException("The analytics export needs pyarrow: pip install pyarrow", status_code=501)
+    return pyarrow
+
+
+def arrow_schema(table):
+    pa = _pyarrow()
+    types = {"int": pa.int64(), "string": pa.string(), "timestamp": pa.timestamp("us")}
+    return pa.schema([(name, types[kind]) for name, kind in EXPORTS[table][1].items()])
+
+
+def read_chunks(table, since=None, chunk_size=50000):
+    """Yield lists of rows newer than the (date, id) watermark since, ordered by (date, id)."""
+    build, _ = EXPORTS[table]
+    query, date_column, id_column = build()
+    query = query.where(date_column.isnot(None)).order_by(date_column, id_column).limit(chunk_size)
+    last_date, last_id = since or (None, None)
+    while True:
+        chunk_query = query
+        if last_date is not None:
+            chunk_query = query.where(or_(
+                date_column > last_date,
+                and_(date_column == last_date, id_column > last_id),
+            ))
+        rows = db.session.execute(chunk_query).all()
+        if not rows:
+            return
+        yield rows
+        last_date, last_id = rows[-1][-1], rows[-1][0]
+        if len(rows) < chunk_size:
+            return
+
+
+def to_record_batch(rows, schema):
+    pa = _pyarrow()
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def load_watermarks(out_dir):
+    path = os.path.join(out_dir, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {table: (datetime.fromisoformat(date), last_id) for table, (date, last_id) in json.load(f).items()}
+
+
+def save_watermarks(out_dir, watermarks):
+    path = os.path.join(out_dir, WATERMARKS_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({table: (date.isoformat(), last_id) for table, (date, last_id) in watermarks.items()}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def published_files(table, out_dir):
+    """The visible part files of table under out_dir."""
+    folder = os.path.join(out_dir, table)
+    if not os.path.isdir(folder):
+        return []
+    return [
+        os.path.join(folder, day, name)
+        for day in os.listdir(folder) if day.startswith("date=")
+        for name in os.listdir(os.path.join(folder, day)) if name.startswith("part-")
+    ]
+
+
+def export_table(table, out_dir, file_format="parquet", chunk_size=50000, since=None, replace=False):
+    """
+    Write the rows newer than since under out_dir/<table>/date=YYYY-MM-DD/, one file per day
+    and run. With replace the files of the previous runs are removed before the new ones
+    are published. Returns the number of rows and the new watermark.
+    """
+    pa = _pyarrow()
+    schema = arrow_schema(table)
+    run_id = uuid.uuid4().hex[:12]
+    extension = "parquet" if file_format == "parquet" else "arrow"
+    written, rows_count, watermark = [], 0, since
+    writer, writer_day = None, None
+    finished = False
+
+    try:
+        for rows in read_chunks(table, since, chunk_size):
+            # rows come ordered by date, so each day is written by a single open writer
+            start = 0
+            while start < len(rows):
+                day = rows[start][-1].date()
+                stop = start
+                while stop < len(rows) and rows[stop][-1].date() == day:
+                    stop += 1
+                if day != writer_day:
+                    if writer is not None:
+                        writer.close()
+                    folder = os.path.join(out_dir, table, f"date={day.isoformat()}")
+                    os.makedirs(folder, exist_ok=True)
+                    name = f"part-{run_id}.{extension}"
+                    # hidden (readers skip dot files) until the whole table is exported,
+                    # so a failed run leaves no partial data behind
+                    written.append((os.path.join(folder, "." + name), os.path.join(folder, name)))
+                    if file_format == "parquet":
+                        writer = pa.parquet.ParquetWriter(written[-1][0], schema, compression="zstd")
+                    else:
+                        writer = pa.ipc.new_file(written[-1][0], schema)
+                    writer_day = day
+                writer.write_batch(to_record_batch(rows[start:stop], schema))
+                start = stop
+            rows_count += len(rows)
+            watermark = (rows[-1][-1], rows[-1][0])
+        finished = True
+    finally:
+        if writer is not None:
+            writer.close()
+        if not finished:
+            for hidden_path, _ in written:
+                if os.path.exists(hidden_path):
+                    os.remove(hidden_path)
+
+    if replace:
+        for path in published_files(table, out_dir):
+            os.remove(path)
+    for hidden_path, path in written:
+        os.replace(hidden_path, path)
+    return rows_count, watermark
+
+
+def export_analytics(out_dir, tables=None, file_format="parquet", chunk_size=50000, full=False):
+    # a full export only starts over the selected tables, the others keep their watermark
+    watermarks = load_watermarks(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    exported = {}
+    for table in tables or EXPORTS:
+        since = None if full else watermarks.get(table)
+        rows_count, watermark = export_table(table, out_dir, file_format, chunk_size, since, replace=full)
+        exported[table] = rows_count
+        if watermark is not None:
+            watermarks[table] = watermark
+        elif full:
+            watermarks.pop(table, None)
+        save_watermarks(out_dir, watermarks)
+    return exported
+
+
+class _ChunkSink(io.RawIOBase):
+    """File-like object keeping what pyarrow writes until the response sends it."""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+@analytics.route("/<table>", methods=["GET"])
+@admin_required
+def stream_table(table):
+    if table not in EXPORTS:
+        raise APIException("Unknown table, expected one of: " + ", ".join(EXPORTS), status_code=404)
+    pa = _pyarrow()
+    since = None
+    if request.args.get("since"):
+        try:
+            since = (datetime.fromisoformat(request.args["since"]), request.args.get("after_id", 0, type=int))
+        except ValueError:
+            raise APIException("since must be an ISO date")
+    chunk_size = min(max(request.args.get("chunk_size", 50000, type=int), 1), 100000)
+    schema = arrow_schema(table)
+
+    def generate():
+        sink = _ChunkSink()
+        with pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema) as writer:
+            for rows in read_chunks(table, since, chunk_size):
+                writer.write_batch(to_record_batch(rows, schema))
+                yield sink.drain()
+        yield sink.drain()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/vnd.apache.arrow.stream",
+        headers={"Content-Disposition": f"attachment; filename={table}.arrows"},
+    )
@@ -0,0 +1,109 @@
+"""
+Single-flight coalescing of identical GET requests.
+
+While a request for a key (endpoint, url arguments and sorted query string) is being
+computed, the identical requests arriving in the same worker wait for its response
+instead of running the same queries again. With COALESCE_STALE_SECONDS > 0 every
+request gets the previous response right away while it is younger than that window,
+in flight or not; once it is older a single request refreshes it and the identical
+ones wait for that refresh.
+"""
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import current_app, request
+
+MAX_STALE_ENTRIES = 1024
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # key -> (stored at, result), only used with a stale window
+        self.results = {}
+        self.counters = Counter()
+
+    def do(self, key, fn, stale_for=0):
+        with self.lock:
+            previous = self.results.get(key) if stale_for > 0 else None
+            if previous is not None and time.monotonic() - previous[0] <= stale_for:
+                self.counters["stale"] += 1
+                return previous[1]
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                self.counters["executed"] += 1
+                leader = True
+            else:
+                leader = False
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if call.error is None and stale_for > 0:
+                    self.results.pop(key, None)
+                    self.results[key] = (time.monotonic(), call.result)
+                    while len(self.results) > MAX_STALE_ENTRIES:
+                        del self.results[next(iter(self.results))]
+            call.done.set()
+        return call.result
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        with self.lock:
+            executed, coalesced, stale = (self.counters[name] for name in ("executed", "coalesced", "stale"))
+        total = executed + coalesced + stale
+        return {
+            "requests": total,
+            "executed": executed,
+            "coalesced": coalesced,
+            "stale": stale,
+            "in_flight": len(self.calls),
+            # share of the requests that didn't run their own queries
+            "coalescing_ratio": (coalesced + stale) / total if total else 0.0,
+        }
+
+
+coalescer = SingleFlight()
+
+
+def coalesce(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+
+        def compute():
+            response = current_app.make_response(view(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
+
+        data, status, headers = coalescer.do(key, compute, current_app.config.get('COALESCE_STALE_SECONDS', 0))
+        # every waiting request gets its own response object
+        return current_app.response_class(data, status=status, headers=headers)
+    return wrapper
@@ -1,6 +1,11 @@
 
+import os
+import resource
+import subprocess
+import sys
 import click
 from api.models import db, User
+from api.analytics import EXPORTS
 
 """
 In this file, you can add as many commands as you want using the @app.cli.command decorator
@@ -31,4 +36,80 @@ def setup_commands(app):
 
     @app.cli.command("insert-test-data")
     def insert_test_data():
-        pass
\ No newline at end of file
+        pass
+
+    """
+    Purge the users marked as deleted whose data the background purge didn't finish,
+    run it from a cronjob: $ flask purge-deleted-users
+    """
+    @app.cli.command("purge-deleted-users")
+    @click.option("--batch-size", default=None, type=int, help="Rows deleted per transaction")
+    def purge_deleted_users(batch_size):
+        from api.purge import purge_deleted_users
+        count = purge_deleted_users(batch_size or app.config['PURGE_BATCH_SIZE'])
+        print(f"Purged {count} deleted users")
+
+    """
+    Move the messages and notifications older than RETENTION_DAYS to the archive tables,
+    run it from a daily cronjob: $ flask archive --days 90
+    """
+    @app.cli.command("archive")
+    @click.option("--days", default=None, type=int, help="Keep this many days in the hot tables")
+    @click.option("--batch-size", default=None, type=int, help="Rows moved per transaction")
+    @click.option("--drop-after-days", default=None, type=int, help="Drop the archived rows older than this")
+    def archive(days, batch_size, drop_after_days):
+        from api.retention import archive_old_rows
+        report = archive_old_rows(
+            days or app.config['RETENTION_DAYS'],
+            batch_size or app.config['ARCHIVE_BATCH_SIZE'],
+            drop_after_days or app.config['ARCHIVE_RETENTION_DAYS'],
+        )
+        for table, (moved, dropped) in report.items():
+            print(f"{table}: {moved} rows archived, {dropped} dropped")
+
+    """
+    Report how long each module takes to import when a worker boots, like python -X importtime
+    but sorted by cumulative time: $ flask import-profile --limit 20
+    """
+    @app.cli.command("import-profile")
+    @click.option("--module", default="app", help="Module to import, the app by default")
+    @click.option("--limit", default=25, help="Number of modules to show")
+    def import_profile(module, limit):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            capture_output=True, text=True, env=os.environ.copy()
+        )
+        if result.returncode != 0:
+            raise click.ClickException(result.stderr.strip().splitlines()[-1])
+
+        modules = []
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            modules.append((int(cumulative_us), int(self_us), name.rstrip()))
+
+        total_us = sum(self_us for _, self_us, _ in modules)
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for cumulative_us, self_us, name in sorted(modules, reverse=True)[:limit]:
+            print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f} {name}")
+        print(f"Imported {len(modules)} modules in {total_us / 1000:.1f} ms, peak RSS {peak_rss / 1024:.1f} MB")
+
+    """
+    Export pairings, favorites, cocktails and dishes as Parquet (or Arrow IPC) files
+    partitioned by day, only the rows added since the previous run: $ flask export-analytics exports/
+    """
+    @app.cli.command("export-analytics")
+    @click.argument("out_dir")
+    @click.option("--format", "file_format", type=click.Choice(["parquet", "arrow"]), default="parquet")
+    @click.option("--table", "tables", multiple=True, type=click.Choice(list(EXPORTS)), help="Only export these tables")
+    @click.option("--chunk-size", default=50000, type=click.IntRange(min=1), help="Rows read from the database at once")
+    @click.option("--full", is_flag=True, help="Export the selected tables again from scratch, replacing their files")
+    def export_analytics(out_dir, file_format, tables, chunk_size, full):
+        from api.analytics import export_analytics
+        exported = export_analytics(out_dir, tables, file_format, chunk_size, full)
+        for table, count in exported.items():
+            print(f"{table}: {count} rows exported")
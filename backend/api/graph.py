@@ -0,0 +1,246 @@
+"""
+In-memory index of the follows table.
+
+Every user has two sorted arrays of 4 byte user ids, the users they follow and their
+followers, so an edge costs 8 bytes plus the small fixed cost of the user's arrays.
+Pages are bisections in those arrays, mutual follows an intersection of the two, and
+the "people you may know" suggestions count the two-hop neighbours with NumPy straight
+on the arrays' memory.
+
+Each worker keeps the index of its app in app.extensions['follow_graph']: built by a
+background thread after first use, the requests reading it are answered 503 until it is
+done (or at startup with GRAPH_PRELOAD, before gunicorn forks, so a recycled worker
+starts with it), updated by the worker's own follows, unfollows and deleted users, and
+rebuilt in the background every GRAPH_REBUILD_SECONDS to pick up the other workers'
+changes while the old graph keeps answering. NumPy is imported by the first suggestions
+request.
+"""
+import logging
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from flask import current_app
+
+from api.models import db, Follow
+from api.utils import APIException
+
+logger = logging.getLogger(__name__)
+
+BUILD_CHUNK_SIZE = 50000
+# two-hop suggestions look at most at this many of the followed users
+SUGGESTION_FANOUT = 500
+
+
+def _insert(arrays, key, value):
+    values = arrays.get(key)
+    if values is None:
+        values = arrays[key] = array('I')
+    position = bisect_left(values, value)
+    if position == len(values) or values[position] != value:
+        values.insert(position, value)
+
+
+def _remove(arrays, key, value):
+    values = arrays.get(key)
+    if values is None:
+        return
+    position = bisect_left(values, value)
+    if position < len(values) and values[position] == value:
+        del values[position]
+    if not values:
+        del arrays[key]
+
+
+def _contains(values, value):
+    position = bisect_left(values, value)
+    return position < len(values) and values[position] == value
+
+
+def _page(values, after, limit):
+    start = bisect_right(values, after)
+    return values[start:start + limit].tolist()
+
+
+class Graph:
+    """Adjacency arrays in both directions."""
+
+    def __init__(self):
+        self.following = {}
+        self.followers = {}
+        self.edges = 0
+
+    def follow(self, follower_id, followed_id):
+        if not _contains(self.following.get(follower_id, ()), followed_id):
+            _insert(self.following, follower_id, followed_id)
+            _insert(self.followers, followed_id, follower_id)
+            self.edges += 1
+
+    def unfollow(self, follower_id, followed_id):
+        if _contains(self.following.get(follower_id, ()), followed_id):
+            _remove(self.following, follower_id, followed_id)
+            _remove(self.followers, followed_id, follower_id)
+            self.edges -= 1
+
+    def remove_user(self, user_id):
+        for followed_id in list(self.following.get(user_id, ())):
+            self.unfollow(user_id, followed_id)
+        for follower_id in list(self.followers.get(user_id, ())):
+            self.unfollow(follower_id, user_id)
+
+
+class GraphIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.graph = None
+        self.built_at = None
+        self.builder = None
+        # writes received while a build runs, replayed on the new graph
+        self.pending = None
+
+    def _load(self):
+        graph = Graph()
+        query = db.select(Follow.follower_id, Follow.followed_id).order_by(Follow.follower_id, Follow.followed_id)
+        for follower_id, followed_id in db.session.execute(query).yield_per(BUILD_CHUNK_SIZE):
+            # rows come sorted by follower, the following arrays are built by appending
+            graph.following.setdefault(follower_id, array('I')).append(followed_id)
+            graph.followers.setdefault(followed_id, array('I')).append(follower_id)
+            graph.edges += 1
+        for user_id, values in graph.followers.items():
+            graph.followers[user_id] = array('I', sorted(values))
+        return graph
+
+    def _build(self, app):
+        started = time.monotonic()
+        with app.app_context():
+            try:
+                graph = self._load()
+            except Exception:
+                logger.exception("Build of the follow graph failed")
+                with self.lock:
+                    self.pending = None
+                return
+        with self.lock:
+            for write in self.pending:
+                write(graph)
+            self.graph, self.pending = graph, None
+            self.built_at = started
+
+    def refresh(self, app, rebuild_after):
+        """
+        Start a build in a background thread when there is no graph yet or it is older
+        than rebuild_after. Returns whether the index can answer.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.builder is not None and self.builder.is_alive():
+                return self.graph is not None
+            # a build thread doesn't survive a fork, its writes are read again by the next build
+            self.pending = None
+            if self.graph is None or now - self.built_at > rebuild_after:
+                self.pending = []
+                self.builder = threading.Thread(target=self._build, args=(app,), daemon=True, name="follow-graph")
+                self.builder.start()
+            return self.graph is not None
+
+    def _write(self, write):
+        with self.lock:
+            if self.graph is not None:
+                write(self.graph)
+            if self.pending is not None:
+                self.pending.append(write)
+
+    def follow(self, follower_id, followed_id):
+        self._write(lambda graph: graph.follow(follower_id, followed_id))
+
+    def unfollow(self, follower_id, followed_id):
+        self._write(lambda graph: graph.unfollow(follower_id, followed_id))
+
+    def remove_user(self, user_id):
+        self._write(lambda graph: graph.remove_user(user_id))
+
+    def following(self, user_id, after=0, limit=50):
+        with self.lock:
+            return _page(self.graph.following.get(user_id, array('I')), after, limit)
+
+    def followers(self, user_id, after=0, limit=50):
+        with self.lock:
+            return _page(self.graph.followers.get(user_id, array('I')), after, limit)
+
+    def mutuals(self, user_id, after=0, limit=50):
+        """Users followed by user_id who follow them back, by id."""
+        with self.lock:
+            following = self.graph.following.get(user_id, array('I'))
+            followers = self.graph.followers.get(user_id, array('I'))
+            # walk the shortest array, look the ids up in the other one
+            shorter, longer = sorted((following, followers), key=len)
+            page = []
+            for other_id in shorter[bisect_right(shorter, after):]:
+                if _contains(longer, other_id):
+                    page.append(other_id)
+                    if len(page) == limit:
+                        break
+            return page
+
+    def suggestions(self, user_id, limit=20):
+        """Users followed by the users user_id follows, most shared first: [(id, shared)]."""
+        import numpy as np
+        with self.lock:
+            following = self.graph.following.get(user_id, array('I'))
+            hops = [
+                np.frombuffer(self.graph.following[other_id], dtype=np.uint32).copy()
+                for other_id in following[:SUGGESTION_FANOUT]
+                if other_id in self.graph.following
+            ]
+            known = np.frombuffer(following, dtype=np.uint32).copy()
+        if not hops:
+            return []
+        candidates, shared = np.unique(np.concatenate(hops), return_counts=True)
+        keep = ~np.isin(candidates, known) & (candidates != user_id)
+        candidates, shared = candidates[keep], shared[keep]
+        # most shared first, the smallest id breaks ties
+        top = np.lexsort((candidates, -shared))[:limit]
+        return [(int(candidates[i]), int(shared[i])) for i in top]
+
+    def stats(self):
+        with self.lock:
+            graph = self.graph
+            if graph is None:
+                return {"built": False}
+            arrays = list(graph.following.values()) + list(graph.followers.values())
+            edge_bytes = sum(len(values) * values.itemsize for values in arrays)
+            total_bytes = (
+                sum(sys.getsizeof(values) for values in arrays)
+                + sys.getsizeof(graph.following) + sys.getsizeof(graph.followers)
+            )
+            return {
+                "built": True,
+                "users": len(set(graph.following) | set(graph.followers)),
+                "edges": graph.edges,
+                "edge_bytes": edge_bytes,
+                "total_bytes": total_bytes,
+                "bytes_per_edge": total_bytes / graph.edges if graph.edges else 0.0,
+            }
+
+
+def graph_index():
+    """The follow graph index of the current app, as it is: for the writes and the stats."""
+    return current_app.extensions['follow_graph']
+
+
+def get_graph():
+    """Return the follow graph index of the current app, rebuilt when needed. 503 until it is built."""
+    index = graph_index()
+    if not index.refresh(current_app._get_current_object(), current_app.config.get('GRAPH_REBUILD_SECONDS', 300)):
+        raise APIException("El grafo de seguidores se está construyendo, inténtalo más tarde.", status_code=503)
+    return index
+
+
+def setup_graph(app):
+    index = app.extensions['follow_graph'] = GraphIndex()
+    if app.config.get('GRAPH_PRELOAD'):
+        # built before gunicorn forks, so no build thread is left running
+        index.refresh(app, 0)
+        index.builder.join()
@@ -0,0 +1,186 @@
+"""
+Idempotency-Key support for the POST endpoints.
+
+A client retrying a write sends the same Idempotency-Key header: the first request runs,
+the retries get its stored response back instead of running again. Keys live
+IDEMPOTENCY_TTL seconds, as a 16 byte digest of the key with the compressed response.
+While its request runs a key is only held IDEMPOTENCY_PENDING_SECONDS, so the key of a
+worker that died mid-request can be claimed again once that lease expires.
+
+IDEMPOTENCY_STORE picks where: "database" (the default) keeps them in the
+idempotency_keys table, shared by every worker, so a retry reaching another worker is
+still replayed; "memory" keeps them in the worker, enough for a single process.
+"""
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, jsonify, request
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from api.models import db, IdempotencyKey
+
+MAX_KEY_LENGTH = 255
+# every this many new keys, a worker deletes a batch of expired ones
+CLEANUP_EVERY = 1000
+CLEANUP_BATCH = 1000
+
+
+class MemoryKeyStore:
+    """Idempotency keys with a TTL, the oldest ones are dropped past max_keys."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # digest -> (expires at, request fingerprint, stored response or None while running)
+        self.keys = OrderedDict()
+
+    def begin(self, digest, fingerprint, lease):
+        """Return ("new", None), ("pending", None), ("mismatch", None) or ("done", response)."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.keys.get(digest)
+            if entry is not None and entry[0] > now:
+                expires, stored_fingerprint, response = entry
+                if stored_fingerprint != fingerprint:
+                    return "mismatch", None
+                if response is None:
+                    return "pending", None
+                return "done", response
+            self.keys.pop(digest, None)
+            self.keys[digest] = (now + lease, fingerprint, None)
+            self._evict(now)
+            return "new", None
+
+    def finish(self, digest, fingerprint, ttl, response):
+        with self.lock:
+            self.keys.pop(digest, None)
+            self.keys[digest] = (time.monotonic() + ttl, fingerprint, response)
+
+    def abandon(self, digest):
+        with self.lock:
+            self.keys.pop(digest, None)
+
+    def _evict(self, now):
+        # keys are kept in insertion order, so the oldest are first
+        while self.keys and (len(self.keys) > self.max_keys or next(iter(self.keys.values()))[0] <= now):
+            self.keys.popitem(last=False)
+
+
+class DatabaseKeyStore:
+    """
+    Idempotency keys in the idempotency_keys table. The primary key on the digest makes
+    claiming a key atomic across workers. Each call runs in its own short transaction on
+    a connection of the engine, apart from the request's session.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claimed = 0
+
+    def _claim(self, connection, values):
+        table = IdempotencyKey.__table__
+        dialect = connection.dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            statement = insert(table).values(**values).on_conflict_do_nothing(index_elements=["digest"])
+            return connection.execute(statement).rowcount == 1
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(**values))
+            return True
+        except IntegrityError:
+            return False
+
+    def begin(self, digest, fingerprint, lease):
+        """Return ("new", None), ("pending", None), ("mismatch", None) or ("done", response)."""
+        table = IdempotencyKey.__table__
+        while True:
+            now = datetime.utcnow()
+            with db.engine.begin() as connection:
+                # an expired key is free again, a pending one once its lease is over
+                connection.execute(delete(table).where(table.c.digest == digest, table.c.expires_at <= now))
+                values = {"digest": digest, "fingerprint": fingerprint, "expires_at": now + timedelta(seconds=lease)}
+                if self._claim(connection, values):
+                    self._cleanup(connection, now)
+                    return "new", None
+                row = connection.execute(select(table).where(table.c.digest == digest)).first()
+            # abandoned between the insert and the select, claim it again
+            if row is None:
+                continue
+            if row.fingerprint != fingerprint:
+                return "mismatch", None
+            if row.status is None:
+                return "pending", None
+            return "done", (row.body, row.status, row.mimetype)
+
+    def finish(self, digest, fingerprint, ttl, response):
+        table = IdempotencyKey.__table__
+        body, status, mimetype = response
+        with db.engine.begin() as connection:
+            connection.execute(update(table).where(table.c.digest == digest).values(
+                expires_at=datetime.utcnow() + timedelta(seconds=ttl), body=body, status=status, mimetype=mimetype,
+            ))
+
+    def abandon(self, digest):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(delete(table).where(table.c.digest == digest))
+
+    def _cleanup(self, connection, now):
+        with self.lock:
+            self.claimed += 1
+            if self.claimed % CLEANUP_EVERY:
+                return
+        table = IdempotencyKey.__table__
+        expired = select(table.c.digest).where(table.c.expires_at <= now).limit(CLEANUP_BATCH)
+        connection.execute(delete(table).where(table.c.digest.in_(expired)))
+
+
+stores = {"memory": MemoryKeyStore(), "database": DatabaseKeyStore()}
+
+
+def idempotent(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({"Error": "Idempotency-Key inválida."}), 400
+
+        ttl = current_app.config.get('IDEMPOTENCY_TTL', 86400)
+        lease = current_app.config.get('IDEMPOTENCY_PENDING_SECONDS', 30)
+        store = stores[current_app.config.get('IDEMPOTENCY_STORE', "database")]
+        digest = hashlib.sha256(f"{request.method} {request.path} {key}".encode()).digest()[:16]
+        fingerprint = hashlib.sha256(request.get_data()).digest()[:8]
+        state, stored = store.begin(digest, fingerprint, lease)
+        if state == "pending":
+            return jsonify({"Error": "Ya se está procesando una petición con esta Idempotency-Key."}), 409
+        if state == "mismatch":
+            return jsonify({"Error": "La Idempotency-Key ya se usó con otros datos."}), 422
+        if state == "done":
+            data, status, mimetype = stored
+            response = current_app.response_class(zlib.decompress(data), status=status, mimetype=mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            store.abandon(digest)
+            raise
+        # server errors are not final, the client may retry them
+        if response.status_code >= 500:
+            store.abandon(digest)
+        else:
+            stored = (zlib.compress(response.get_data()), response.status_code, response.mimetype)
+            store.finish(digest, fingerprint, ttl, stored)
+        return response
+    return wrapper
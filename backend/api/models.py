@@ -1,11 +1,53 @@
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, ForeignKey, Enum, Integer, String, Date
+from sqlalchemy import Column, ForeignKey, Enum, Integer, String, Date, DDL, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy import create_engine
 
 
 db = SQLAlchemy()
 
+# SQLite ignores foreign keys, and so the ON DELETE rules, unless asked for every connection
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def insert_or_ignore(model, values, conflict_columns):
+    """
+    INSERT ... ON CONFLICT (conflict_columns) DO NOTHING, a retried insert is a no-op
+    instead of an IntegrityError. Returns True when the row was inserted.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect not in ("postgresql", "sqlite"):
+        # no native upsert, fall back to catching the conflict in a savepoint
+        try:
+            with db.session.begin_nested():
+                db.session.add(model(**values))
+            return True
+        except IntegrityError:
+            return False
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = insert(model).values(**values).on_conflict_do_nothing(index_elements=conflict_columns)
+    return db.session.execute(statement).rowcount == 1
+
+class IdempotencyKey(db.Model):
+    """An Idempotency-Key seen by any worker, with its response once the request finished."""
+    __tablename__ = 'idempotency_keys'
+
+    digest = db.Column(db.LargeBinary(16), primary_key=True)
+    fingerprint = db.Column(db.LargeBinary(8), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    # NULL while the first request runs
+    status = db.Column(db.Integer)
+    mimetype = db.Column(db.String(100))
+    body = db.Column(db.LargeBinary)
+
 class User(db.Model):
     __tablename__ = 'users'
     
@@ -14,9 +56,11 @@ class User(db.Model):
     username = db.Column(db.String(50), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)  # Encrypted
-    registration_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    registration_date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
     profile_info = db.Column(db.Text)
     avatar_url = db.Column(db.String(255))
+    # set when the account is deleted, the rows are purged later in background batches
+    deleted_at = db.Column(db.DateTime, index=True)
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -57,10 +101,10 @@ class Cocktail(db.Model):
     name = db.Column(db.String(100), nullable=False)
     preparation_steps = db.Column(db.Text, nullable=False)
     flavor_profile = db.Column(db.Enum('sweet', 'sour', 'bitter', 'salty', 'umami',name='cocktail_enum'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    creation_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), index=True)
+    creation_date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
 
-    user = db.relationship('User', backref=db.backref('cocktails', lazy=True))
+    user = db.relationship('User', backref=db.backref('cocktails', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Cocktail {self.name}>'
@@ -81,10 +125,10 @@ class Dish(db.Model):
     name = db.Column(db.String(100), nullable=False)
     preparation_steps = db.Column(db.Text, nullable=False)
     flavor_profile = db.Column(db.Enum('sweet', 'sour', 'bitter', 'salty', 'umami',  name='flavor_profile_enum'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    creation_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), index=True)
+    creation_date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
 
-    user = db.relationship('User', backref=db.backref('dishes', lazy=True))
+    user = db.relationship('User', backref=db.backref('dishes', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Dish {self.name}>'
@@ -101,16 +145,21 @@ class Dish(db.Model):
 
 class Favorite(db.Model):
     __tablename__ = 'favorites'
+    # a user saves a cocktail or a dish only once, NULLs don't collide
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'cocktail_id', name='uq_favorites_user_cocktail'),
+        db.UniqueConstraint('user_id', 'dish_id', name='uq_favorites_user_dish'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    cocktail_id = db.Column(db.Integer, db.ForeignKey('cocktails.id'))
-    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'))
-    saved_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    cocktail_id = db.Column(db.Integer, db.ForeignKey('cocktails.id', ondelete='CASCADE'), index=True)
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id', ondelete='CASCADE'), index=True)
+    saved_date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
 
-    user = db.relationship('User', backref=db.backref('favorites', lazy=True))
-    cocktail = db.relationship('Cocktail', backref=db.backref('favorites', lazy=True))
-    dish = db.relationship('Dish', backref=db.backref('favorites', lazy=True))
+    user = db.relationship('User', backref=db.backref('favorites', lazy=True, passive_deletes=True))
+    cocktail = db.relationship('Cocktail', backref=db.backref('favorites', lazy=True, passive_deletes=True))
+    dish = db.relationship('Dish', backref=db.backref('favorites', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Favorite User: {self.user_id}, Cocktail: {self.cocktail_id}, Dish: {self.dish_id}>'
@@ -127,14 +176,14 @@ class Pairing(db.Model):
     __tablename__ = 'pairings'
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    cocktail_id = db.Column(db.Integer, db.ForeignKey('cocktails.id'))
-    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'))
-    saved_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    cocktail_id = db.Column(db.Integer, db.ForeignKey('cocktails.id', ondelete='CASCADE'), index=True)
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id', ondelete='CASCADE'), index=True)
+    saved_date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
 
-    user = db.relationship('User', backref=db.backref('pairings', lazy=True))
-    cocktail = db.relationship('Cocktail', backref=db.backref('pairings', lazy=True))
-    dish = db.relationship('Dish', backref=db.backref('pairings', lazy=True))
+    user = db.relationship('User', backref=db.backref('pairings', lazy=True, passive_deletes=True))
+    cocktail = db.relationship('Cocktail', backref=db.backref('pairings', lazy=True, passive_deletes=True))
+    dish = db.relationship('Dish', backref=db.backref('pairings', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Pairing User: {self.user_id}, Cocktail: {self.cocktail_id}, Dish: {self.dish_id}>'
@@ -151,11 +200,11 @@ class Post(db.Model):
     __tablename__ = 'posts'
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
     content = db.Column(db.Text, nullable=False)
     creation_date = db.Column(db.DateTime, default=db.func.current_timestamp())
 
-    user = db.relationship('User', backref=db.backref('posts', lazy=True))
+    user = db.relationship('User', backref=db.backref('posts', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Post User: {self.user_id}, Content: {self.content[:20]}>'
@@ -171,13 +220,13 @@ class Comment(db.Model):
     __tablename__ = 'comments'
 
     id = db.Column(db.Integer, primary_key=True)
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
     content = db.Column(db.Text, nullable=False)
     creation_date = db.Column(db.DateTime, default=db.func.current_timestamp())
 
-    post = db.relationship('Post', backref=db.backref('comments', lazy=True))
-    user = db.relationship('User', backref=db.backref('comments', lazy=True))
+    post = db.relationship('Post', backref=db.backref('comments', lazy=True, passive_deletes=True))
+    user = db.relationship('User', backref=db.backref('comments', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Comment User: {self.user_id}, Post: {self.post_id}, Content: {self.content[:20]}>'
@@ -211,11 +260,11 @@ class Chat(db.Model):
 class ChatParticipant(db.Model):
     __tablename__ = 'chat_participants'
 
-    chat_id = db.Column(db.Integer, db.ForeignKey('chats.id'), primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, index=True)
 
-    chat = db.relationship('Chat', backref=db.backref('chat_participants', lazy=True))
-    user = db.relationship('User', backref=db.backref('chat_participants', lazy=True))
+    chat = db.relationship('Chat', backref=db.backref('chat_participants', lazy=True, passive_deletes=True))
+    user = db.relationship('User', backref=db.backref('chat_participants', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<ChatParticipant Chat: {self.chat_id}, User: {self.user_id}>'
@@ -227,15 +276,19 @@ class ChatParticipant(db.Model):
         }
 class Message(db.Model):
     __tablename__ = 'messages'
+    # the history of a chat is read newest first
+    __table_args__ = (
+        db.Index('ix_messages_chat_id_sent_date', 'chat_id', 'sent_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    chat_id = db.Column(db.Integer, db.ForeignKey('chats.id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    chat_id = db.Column(db.Integer, db.ForeignKey('chats.id', ondelete='CASCADE'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
     content = db.Column(db.Text, nullable=False)
-    sent_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    sent_date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
 
-    chat = db.relationship('Chat', backref=db.backref('messages', lazy=True))
-    user = db.relationship('User', backref=db.backref('messages', lazy=True))
+    chat = db.relationship('Chat', backref=db.backref('messages', lazy=True, passive_deletes=True))
+    user = db.relationship('User', backref=db.backref('messages', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Message Chat: {self.chat_id}, User: {self.user_id}, Content: {self.content[:20]}>'
@@ -250,15 +303,18 @@ class Message(db.Model):
         }
 class Notification(db.Model):
     __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_date', 'user_id', 'date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     type = db.Column(db.Enum('comment', 'message', 'new_follower', 'other',  name='notification_enum'), nullable=False)
     content = db.Column(db.Text)
     read = db.Column(db.Boolean, default=False)
-    date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    date = db.Column(db.DateTime, default=db.func.current_timestamp(), index=True)
 
-    user = db.relationship('User', backref=db.backref('notifications', lazy=True))
+    user = db.relationship('User', backref=db.backref('notifications', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Notification User: {self.user_id}, Type: {self.type}>'
@@ -272,15 +328,78 @@ class Notification(db.Model):
             "read": self.read,
             "date": self.date
         }
+
+# Messages and notifications older than RETENTION_DAYS, moved out of the tables above by
+# `flask archive`. Postgres splits them in monthly range partitions, created by the
+# command as it needs them; the date is part of the primary key, as partitioning requires.
+class MessageArchive(db.Model):
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_chat_id_sent_date', 'chat_id', 'sent_date'),
+        {'postgresql_partition_by': 'RANGE (sent_date)'},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sent_date = db.Column(db.DateTime, primary_key=True)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chats.id', ondelete='CASCADE'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    content = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f'<MessageArchive Chat: {self.chat_id}, User: {self.user_id}, Content: {self.content[:20]}>'
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "chat_id": self.chat_id,
+            "user_id": self.user_id,
+            "content": self.content,
+            "sent_date": self.sent_date
+        }
+class NotificationArchive(db.Model):
+    __tablename__ = 'notifications_archive'
+    __table_args__ = (
+        db.Index('ix_notifications_archive_user_id_date', 'user_id', 'date'),
+        {'postgresql_partition_by': 'RANGE (date)'},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    type = db.Column(db.Enum('comment', 'message', 'new_follower', 'other',  name='notification_enum'), nullable=False)
+    content = db.Column(db.Text)
+    read = db.Column(db.Boolean, default=False)
+
+    def __repr__(self):
+        return f'<NotificationArchive User: {self.user_id}, Type: {self.type}>'
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "type": self.type,
+            "content": self.content,
+            "read": self.read,
+            "date": self.date
+        }
+
+# rows outside every monthly partition land here instead of failing the insert
+for _archive in (MessageArchive, NotificationArchive):
+    event.listen(
+        _archive.__table__,
+        "after_create",
+        DDL(f"CREATE TABLE IF NOT EXISTS {_archive.__tablename__}_default PARTITION OF {_archive.__tablename__} DEFAULT")
+        .execute_if(dialect="postgresql"),
+    )
 class Follow(db.Model):
     __tablename__ = 'follows'
 
-    follower_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-    followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    follower_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    followed_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, index=True)
     date = db.Column(db.DateTime, default=db.func.current_timestamp())
 
-    follower = db.relationship('User', foreign_keys=[follower_id], backref=db.backref('follows', lazy=True))
-    followed = db.relationship('User', foreign_keys=[followed_id], backref=db.backref('followers', lazy=True))
+    follower = db.relationship('User', foreign_keys=[follower_id], backref=db.backref('follows', lazy=True, passive_deletes=True))
+    followed = db.relationship('User', foreign_keys=[followed_id], backref=db.backref('followers', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f'<Follow Follower: {self.follower_id}, Following: {self.followed_id}>'
@@ -0,0 +1,192 @@
+"""
+Opt-in request profiler.
+
+A profiled request is followed by a background thread that samples its stack as it
+starts and then every PROFILING_INTERVAL seconds, so even a request shorter than the
+interval has a sample. The samples are kept as collapsed stacks ("a;b;c 12" per
+line), the input format of flamegraph.pl and speedscope, both for the request itself
+and merged per route. A request is profiled when it sends `X-Profile: 1` together with
+the admin token, or randomly with probability PROFILING_SAMPLE_RATE.
+
+Profiles are kept in the memory of the worker that served the request: with several
+gunicorn workers, /api/profiles only lists the ones of the worker answering it (the
+"pid" of each profile tells them apart), ask again or run a single worker to see them all.
+
+Nothing is registered unless PROFILING is enabled, so it costs nothing when off.
+"""
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+from flask import Blueprint, Response, current_app, g, jsonify, request
+
+from api.utils import APIException, admin_required, is_admin
+
+profiling = Blueprint('profiling', __name__)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f"{module}:{code.co_name}:{code.co_firstlineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def to_collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread until stopped."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            self.stacks[collapse(frame)] += 1
+
+    def run(self):
+        self.sample()
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+
+class ProfileStore:
+    """Keeps the latest profiles and the samples merged per route, in memory."""
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.profiles = deque(maxlen=size)
+        self.routes = {}
+
+    def add(self, endpoint, method, path, duration, stacks):
+        profile = {
+            "id": uuid.uuid4().hex,
+            "pid": os.getpid(),
+            "endpoint": endpoint,
+            "method": method,
+            "path": path,
+            "date": time.time(),
+            "duration_ms": duration * 1000,
+            "samples": sum(stacks.values()),
+            "stacks": stacks,
+        }
+        with self.lock:
+            self.profiles.append(profile)
+            route = self.routes.setdefault(endpoint, {"requests": 0, "duration_ms": 0.0, "stacks": Counter()})
+            route["requests"] += 1
+            route["duration_ms"] += profile["duration_ms"]
+            route["stacks"].update(stacks)
+        return profile
+
+    def get(self, profile_id):
+        with self.lock:
+            return next((p for p in self.profiles if p["id"] == profile_id), None)
+
+
+def setup_profiling(app):
+    if not app.config.get('PROFILING'):
+        return
+
+    store = app.extensions['profiling'] = ProfileStore(app.config.get('PROFILING_HISTORY', 200))
+    sample_rate = app.config.get('PROFILING_SAMPLE_RATE', 0.0)
+    interval = app.config.get('PROFILING_INTERVAL', 0.005)
+
+    @app.before_request
+    def start_profile():
+        if request.blueprint == 'profiling':
+            return
+        requested = request.headers.get('X-Profile') == '1' and is_admin()
+        if requested or random.random() < sample_rate:
+            g.profile_started = time.perf_counter()
+            g.profile_sampler = StackSampler(threading.get_ident(), interval).start()
+
+    @app.teardown_request
+    def stop_profile(exc):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is None:
+            return
+        stacks = sampler.stop()
+        duration = time.perf_counter() - g.pop('profile_started')
+        store.add(request.endpoint or 'unknown', request.method, request.path, duration, stacks)
+
+    app.register_blueprint(profiling, url_prefix='/api/profiles')
+
+
+def _store():
+    return current_app.extensions['profiling']
+
+
+@profiling.route("", methods=["GET"])
+@admin_required
+def list_profiles():
+    with _store().lock:
+        profiles = list(_store().profiles)
+    return jsonify([
+        {key: value for key, value in profile.items() if key != "stacks"}
+        for profile in reversed(profiles)
+    ])
+
+
+@profiling.route("/<profile_id>", methods=["GET"])
+@admin_required
+def download_profile(profile_id):
+    profile = _store().get(profile_id)
+    if profile is None:
+        raise APIException("Profile not found", status_code=404)
+    return Response(
+        to_collapsed(profile["stacks"]),
+        mimetype="text/plain",
+        headers={"Content-Disposition": f"attachment; filename={profile['endpoint']}-{profile_id}.folded"},
+    )
+
+
+@profiling.route("/routes", methods=["GET"])
+@admin_required
+def list_routes():
+    with _store().lock:
+        return jsonify({
+            endpoint: {
+                "requests": route["requests"],
+                "mean_duration_ms": route["duration_ms"] / route["requests"],
+                "samples": sum(route["stacks"].values()),
+            }
+            for endpoint, route in _store().routes.items()
+        })
+
+
+@profiling.route("/routes/<endpoint>", methods=["GET"])
+@admin_required
+def download_route(endpoint):
+    with _store().lock:
+        route = _store().routes.get(endpoint)
+        if route is None:
+            raise APIException("No profiles for this route", status_code=404)
+        collapsed = to_collapsed(route["stacks"])
+    return Response(
+        collapsed,
+        mimetype="text/plain",
+        headers={"Content-Disposition": f"attachment; filename={endpoint}.folded"},
+    )
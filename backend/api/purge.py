@@ -0,0 +1,89 @@
+"""
+Removal of deleted user accounts.
+
+Deleting a user on the request path only marks it with deleted_at. The rows that
+depend on it are then removed in small batches, each one in its own short
+transaction, by a background thread of the worker or by `flask purge-deleted-users`,
+which also catches the accounts a restarted worker didn't finish.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import delete, select, update
+
+from api.models import (
+    db, User, Cocktail, Dish, Favorite, Pairing, Post, Comment, ChatParticipant, Message, Notification, Follow,
+    MessageArchive, NotificationArchive,
+)
+
+logger = logging.getLogger(__name__)
+
+# (model, column pointing to the user, column telling apart the rows of one user)
+PURGE_STEPS = (
+    (Favorite, Favorite.user_id, Favorite.id),
+    (Pairing, Pairing.user_id, Pairing.id),
+    (Comment, Comment.user_id, Comment.id),
+    # the comments of the user's posts go with them through ON DELETE CASCADE
+    (Post, Post.user_id, Post.id),
+    (Message, Message.user_id, Message.id),
+    (Notification, Notification.user_id, Notification.id),
+    (MessageArchive, MessageArchive.user_id, MessageArchive.id),
+    (NotificationArchive, NotificationArchive.user_id, NotificationArchive.id),
+    (ChatParticipant, ChatParticipant.user_id, ChatParticipant.chat_id),
+    (Follow, Follow.follower_id, Follow.followed_id),
+    (Follow, Follow.followed_id, Follow.follower_id),
+)
+# Recipes stay, without author
+DETACH_STEPS = (
+    (Cocktail, Cocktail.user_id, Cocktail.id),
+    (Dish, Dish.user_id, Dish.id),
+)
+
+executor = None
+
+
+def _in_batches(statement_for_batch, batch_size):
+    while True:
+        result = db.session.execute(statement_for_batch(), execution_options={"synchronize_session": False})
+        db.session.commit()
+        if result.rowcount < batch_size:
+            return
+
+
+def purge_user(user_id, batch_size=1000):
+    """Delete a soft-deleted user and everything depending on it, batch_size rows per transaction."""
+    for model, user_column, key in PURGE_STEPS:
+        batch = select(key).where(user_column == user_id).limit(batch_size)
+        _in_batches(lambda: delete(model).where(user_column == user_id, key.in_(batch)), batch_size)
+
+    for model, user_column, key in DETACH_STEPS:
+        batch = select(key).where(user_column == user_id).limit(batch_size)
+        _in_batches(lambda: update(model).where(key.in_(batch)).values({user_column: None}), batch_size)
+
+    # nothing references the user anymore, this delete doesn't cascade
+    db.session.execute(delete(User).where(User.id == user_id, User.deleted_at.isnot(None)))
+    db.session.commit()
+
+
+def purge_deleted_users(batch_size=1000):
+    user_ids = db.session.scalars(select(User.id).where(User.deleted_at.isnot(None))).all()
+    for user_id in user_ids:
+        purge_user(user_id, batch_size)
+    return len(user_ids)
+
+
+def _purge_in_background(app, user_id):
+    with app.app_context():
+        try:
+            purge_user(user_id, app.config.get('PURGE_BATCH_SIZE', 1000))
+        except Exception:
+            db.session.rollback()
+            logger.exception("Purge of user %s failed, `flask purge-deleted-users` will retry it", user_id)
+
+
+def schedule_purge(app, user_id):
+    global executor
+    # a single thread, purges are not urgent and must not compete with the requests
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="purge")
+    executor.submit(_purge_in_background, app, user_id)
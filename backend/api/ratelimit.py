@@ -0,0 +1,153 @@
+"""
+Rate limiting and admission control of the API.
+
+Every request takes a token from two token buckets, one per client and one per client
+and route, and is answered 429 with a Retry-After when either is empty. Routes are
+limited by kind: writes and the unpaginated lists get less than the other reads,
+ROUTE_LIMITS overrides single endpoints. A bucket holds BURST_SECONDS of its rate.
+
+The request then takes a slot of the worker's concurrency cap, API_MAX_CONCURRENCY, by
+default one less than the worker's threads: past it the request is answered 503 right
+away (or after ADMISSION_WAIT_SECONDS) by the spare thread instead of queueing for a
+thread and a connection, so an overload is shed at a constant cost instead of growing
+every request's latency. A cap at or above the threads is never reached.
+
+Buckets live in a RateLimitStore. MemoryStore keeps them in the worker, each worker then
+applies the limits on its own; a store shared by the workers (Redis, memcached)
+implements the same take method.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+
+from flask import current_app, g, jsonify, request
+
+BURST_SECONDS = 10
+# requests per minute of single endpoints, instead of the limit of their kind
+ROUTE_LIMITS = {
+    # hashing the password is expensive on purpose
+    "api.create_user": 10,
+}
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class RateLimitStore(ABC):
+    """Token buckets by key."""
+
+    @abstractmethod
+    def take(self, key, rate, burst):
+        """
+        Take a token from the bucket of key, refilled at rate tokens per second up to burst.
+        Returns 0 when it was taken, otherwise the seconds until the next token.
+        """
+
+
+class MemoryStore(RateLimitStore):
+    """Buckets in the worker's memory, the least recently used dropped past max_keys."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # key -> (tokens, updated at)
+        self.buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+class Limiter:
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.slots = None
+        self.capacity = None
+        self.in_flight = 0
+        self.counters = Counter()
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _semaphore(self, capacity):
+        with self.lock:
+            if self.capacity != capacity:
+                self.slots = threading.BoundedSemaphore(capacity) if capacity else None
+                self.capacity = capacity
+            return self.slots
+
+    def kind(self):
+        if request.method in WRITE_METHODS:
+            return "write"
+        # a GET without url arguments is one of the unpaginated lists
+        return "read" if request.view_args else "list"
+
+    def client(self):
+        # behind PROXY_HOPS proxies, ProxyFix has already set it from X-Forwarded-For
+        return request.remote_addr or "unknown"
+
+    def limit(self, key, per_minute):
+        rate = per_minute / 60
+        return self.store.take(key, rate, max(1.0, rate * BURST_SECONDS))
+
+    def admit(self):
+        """Admit the request, or return the 429/503 response refusing it."""
+        config = current_app.config
+        if request.method == "OPTIONS":
+            return None
+
+        if config.get('RATE_LIMIT'):
+            client, kind = self.client(), self.kind()
+            per_route = ROUTE_LIMITS.get(request.endpoint, config[f'RATE_LIMIT_{kind.upper()}'])
+            wait = max(
+                self.limit(client, config['RATE_LIMIT_CLIENT']),
+                self.limit(f"{client} {request.endpoint}", per_route),
+            )
+            if wait:
+                self._count(f"limited_{kind}")
+                response = jsonify({"Error": "Demasiadas peticiones, inténtalo más tarde."})
+                response.headers["Retry-After"] = str(int(wait) + 1)
+                return response, 429
+
+        slots = self._semaphore(config.get('API_MAX_CONCURRENCY', 0))
+        if slots is not None:
+            if not slots.acquire(timeout=config.get('ADMISSION_WAIT_SECONDS', 0)):
+                self._count("shed")
+                response = jsonify({"Error": "Servidor saturado, inténtalo más tarde."})
+                response.headers["Retry-After"] = "1"
+                return response, 503
+            g.admission_slots = slots
+        with self.lock:
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+            self.counters["peak_in_flight"] = max(self.counters["peak_in_flight"], self.in_flight)
+        g.admitted = True
+        return None
+
+    def release(self):
+        if not g.pop("admitted", False):
+            return
+        with self.lock:
+            self.in_flight -= 1
+        slots = g.pop("admission_slots", None)
+        if slots is not None:
+            slots.release()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=self.in_flight, capacity=self.capacity)
+
+
+limiter = Limiter(MemoryStore())
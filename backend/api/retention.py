@@ -0,0 +1,158 @@
+"""
+Retention of messages and notifications.
+
+The messages and notifications tables only keep the last RETENTION_DAYS: `flask archive`
+moves the older rows, batch_size per transaction, to messages_archive and
+notifications_archive. On Postgres those are range partitioned by month, the command
+creates the partition of a month before moving its first row, and dropping a month
+past ARCHIVE_RETENTION_DAYS is a DROP TABLE instead of a delete. On SQLite they are
+plain tables.
+
+The hot tables and their indexes stay the size of the retention window whatever the
+size of the history, the history endpoints read them first and only go to the archive
+for the rows past them.
+"""
+import logging
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, insert, or_, select, text
+
+from api.models import db, Message, MessageArchive, Notification, NotificationArchive
+
+logger = logging.getLogger(__name__)
+
+# (hot model, archive model, date column name)
+ARCHIVES = (
+    (Message, MessageArchive, "sent_date"),
+    (Notification, NotificationArchive, "date"),
+)
+PARTITION_NAME = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+def _month(date):
+    return datetime(date.year, date.month, 1)
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _is_postgres():
+    return db.session.get_bind().dialect.name == "postgresql"
+
+
+def partitions(archive):
+    """{first day of the month: partition name} of a partitioned archive table."""
+    names = db.session.execute(text(
+        "SELECT child.relname FROM pg_inherits"
+        " JOIN pg_class parent ON pg_inherits.inhparent = parent.oid"
+        " JOIN pg_class child ON pg_inherits.inhrelid = child.oid"
+        " WHERE parent.relname = :parent"
+    ), {"parent": archive.__tablename__}).scalars()
+    months = {}
+    for name in names:
+        match = PARTITION_NAME.search(name)
+        if match:
+            months[datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def ensure_partitions(archive, first_date, last_date):
+    """Create the monthly partitions of archive from first_date to last_date, on Postgres."""
+    if not _is_postgres():
+        return
+    existing = partitions(archive)
+    month = _month(first_date)
+    while month <= last_date:
+        if month not in existing:
+            name = f"{archive.__tablename__}_p{month.year}_{month.month:02d}"
+            db.session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {archive.__tablename__}"
+                f" FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+            ))
+        month = _next_month(month)
+
+
+def archive_table(hot, archive, date_name, cutoff, batch_size=5000):
+    """Move the rows of hot older than cutoff to archive, oldest first. Returns the number moved."""
+    date_column = getattr(hot, date_name)
+    columns = [column.name for column in archive.__table__.columns]
+    moved = 0
+    while True:
+        batch = db.session.execute(
+            select(hot.id, date_column).where(date_column < cutoff).order_by(date_column, hot.id).limit(batch_size)
+        ).all()
+        if not batch:
+            return moved
+        ids = [row_id for row_id, _ in batch]
+        ensure_partitions(archive, batch[0][1], batch[-1][1])
+        # the copy and the delete commit together, a row is never in both tables or in none
+        db.session.execute(insert(archive).from_select(
+            columns, select(*[getattr(hot, name) for name in columns]).where(hot.id.in_(ids))
+        ))
+        db.session.execute(delete(hot).where(hot.id.in_(ids)), execution_options={"synchronize_session": False})
+        db.session.commit()
+        moved += len(batch)
+        if len(batch) < batch_size:
+            return moved
+
+
+def drop_expired(archive, date_name, cutoff, batch_size=5000):
+    """Remove the archived rows older than cutoff. Returns the number of rows, or partitions on Postgres."""
+    if _is_postgres():
+        # only the months entirely before the cutoff, the current one waits for next month
+        dropped = 0
+        for month, name in sorted(partitions(archive).items()):
+            if _next_month(month) <= cutoff:
+                db.session.execute(text(f"DROP TABLE {name}"))
+                dropped += 1
+        db.session.commit()
+        return dropped
+
+    date_column = getattr(archive, date_name)
+    removed = 0
+    while True:
+        batch = select(archive.id).where(date_column < cutoff).limit(batch_size)
+        result = db.session.execute(
+            delete(archive).where(date_column < cutoff, archive.id.in_(batch)),
+            execution_options={"synchronize_session": False},
+        )
+        db.session.commit()
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            return removed
+
+
+def archive_old_rows(days, batch_size=5000, drop_after_days=None):
+    """Archive the messages and notifications older than days, and drop the archive past drop_after_days."""
+    now = datetime.now()
+    report = {}
+    for hot, archive, date_name in ARCHIVES:
+        moved = archive_table(hot, archive, date_name, now - timedelta(days=days), batch_size)
+        dropped = 0
+        if drop_after_days:
+            dropped = drop_expired(archive, date_name, now - timedelta(days=drop_after_days), batch_size)
+        logger.info("Archived %d rows of %s, dropped %d", moved, hot.__tablename__, dropped)
+        report[hot.__tablename__] = (moved, dropped)
+    return report
+
+
+def history(hot, archive, date_name, where, before=None, before_id=None, limit=50):
+    """
+    The rows matching where of hot and then archive, newest first, older than the
+    (before, before_id) cursor: hot holds every row newer than the archived ones, so
+    the archive is only read when hot runs out.
+    """
+    rows = []
+    for model in (hot, archive):
+        date_column = getattr(model, date_name)
+        query = select(model).where(*where(model)).order_by(date_column.desc(), model.id.desc())
+        if before is not None and before_id is not None:
+            query = query.where(or_(date_column < before, and_(date_column == before, model.id < before_id)))
+        elif before is not None:
+            query = query.where(date_column < before)
+        rows += db.session.execute(query.limit(limit - len(rows))).scalars().all()
+        if len(rows) == limit:
+            break
+    return rows
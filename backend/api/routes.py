@@ -1,32 +1,70 @@
 """
 Este módulo se encarga de iniciar el servidor API, cargar la base de datos y agregar los endpoints.
 """
-from flask import Flask, request, jsonify, url_for, Blueprint
-from api.models import db, User, Ingredient, Cocktail, Dish, Favorite, Pairing
-from api.utils import generate_sitemap, APIException
+from flask import Flask, request, jsonify, url_for, Blueprint, current_app
+from api.models import (
+    db, User, Ingredient, Cocktail, Dish, Favorite, Pairing, Follow, Message, MessageArchive,
+    Notification, NotificationArchive, insert_or_ignore,
+)
+from api.purge import schedule_purge
+from api.utils import generate_sitemap, APIException, admin_required
+from api.coalescing import coalesce, coalescer
+from api.idempotency import idempotent
+from api import similarity
+from api.graph import get_graph, graph_index
+from api.retention import history
+from api.ratelimit import limiter
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 api = Blueprint('api', __name__)
 
 # Permitir solicitudes CORS
 CORS(api)
 
+# Límites por cliente y por ruta, y rechazo inmediato cuando el worker está saturado
+@api.before_request
+def admit_request():
+    return limiter.admit()
+
+@api.teardown_request
+def release_request(error=None):
+    limiter.release()
+
+# Las escrituras invalidan las respuestas guardadas para las peticiones coalescidas
+@api.after_request
+def invalidate_coalesced_reads(response):
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        coalescer.clear()
+    return response
+
+@api.route("/metrics", methods=["GET"])
+@admin_required
+def get_metrics():
+    return jsonify({
+        "coalescing": coalescer.stats(),
+        "follow_graph": graph_index().stats(),
+        "admission": limiter.stats()
+    })
+
 # Endpoints sobre usuarios
 @api.route("/users", methods=["GET"])
 def get_users():
-    users = User.query.all()
+    users = User.query.filter(User.deleted_at.is_(None)).all()
     return jsonify([user.serialize() for user in users])
 
 @api.route("/user/<int:user_id>", methods=["GET"])
 def get_user(user_id):
-    user = User.query.get_or_404(user_id)
+    user = User.query.filter_by(id=user_id, deleted_at=None).first_or_404()
     return jsonify(user.serialize())
 
 @api.route("/new-user", methods=["POST"])
+@idempotent
 def create_user():
     data = request.json
     if not data:
@@ -55,7 +93,7 @@ def update_user(user_id):
         return jsonify({"error": "No se proporcionaron datos de entrada."}), 400
     
     user = User.query.get(user_id)
-    if not user:
+    if not user or user.deleted_at is not None:
         return jsonify({"error": "Usuario no encontrado"}), 404
     
     # Actualizar los campos solo si están presentes en la solicitud
@@ -78,30 +116,141 @@ def update_user(user_id):
 
 @api.route("/user/<int:user_id>", methods=["DELETE"])
 def delete_user(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({"error": "Usuario no encontrado"}), 404
-    
     try:
-        db.session.delete(user)
+        if current_app.config.get('USER_DELETE_MODE') == "sync":
+            # Un solo DELETE, la base de datos borra los datos dependientes (ON DELETE)
+            deleted = User.query.filter_by(id=user_id).delete(synchronize_session=False)
+        else:
+            # Se marca como borrado y los datos se purgan en segundo plano por lotes
+            deleted = User.query.filter_by(id=user_id, deleted_at=None).update(
+                {"deleted_at": db.func.current_timestamp()}, synchronize_session=False)
+        if not deleted:
+            return jsonify({"error": "Usuario no encontrado"}), 404
         db.session.commit()
+        if current_app.config.get('USER_DELETE_MODE') != "sync":
+            schedule_purge(current_app._get_current_object(), user_id)
+        graph_index().remove_user(user_id)
         return jsonify({"msg": "Usuario eliminado correctamente"}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+# Endpoints sobre seguidores, servidos desde el índice en memoria del grafo
+def users_page(user_ids, limit):
+    # Una sola consulta para la página, en el orden del índice
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids), User.deleted_at.is_(None))}
+    return jsonify({
+        "users": [users[user_id].serialize() for user_id in user_ids if user_id in users],
+        "next_after": user_ids[-1] if len(user_ids) == limit else None
+    })
+
+def page_args():
+    after = request.args.get("after", 0, type=int)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+    return after, limit
+
+@api.route("/follow", methods=["POST"])
+@idempotent
+def create_follow():
+    data = request.json
+    if not data:
+        return jsonify({"error": "No se proporcionaron datos de entrada."}), 400
+    follower_id = data.get("follower_id")
+    followed_id = data.get("followed_id")
+    # el índice en memoria solo guarda enteros positivos, bool también es un int
+    for user_id in (follower_id, followed_id):
+        if not isinstance(user_id, int) or isinstance(user_id, bool) or user_id <= 0:
+            return jsonify({"error": "follower_id y followed_id deben ser ids de usuario."}), 400
+    if follower_id == followed_id:
+        return jsonify({"error": "Un usuario no puede seguirse a sí mismo."}), 400
+
+    try:
+        created = insert_or_ignore(Follow, {"follower_id": follower_id, "followed_id": followed_id},
+                                   ["follower_id", "followed_id"])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "Usuario no encontrado"}), 404
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+    graph_index().follow(follower_id, followed_id)
+    return jsonify({"follower_id": follower_id, "followed_id": followed_id}), 201 if created else 200
+
+@api.route("/follow/<int:follower_id>/<int:followed_id>", methods=["DELETE"])
+def delete_follow(follower_id, followed_id):
+    deleted = Follow.query.filter_by(follower_id=follower_id, followed_id=followed_id).delete(synchronize_session=False)
+    if not deleted:
+        return jsonify({"error": "No sigue a ese usuario"}), 404
+    db.session.commit()
+    graph_index().unfollow(follower_id, followed_id)
+    return jsonify({"msg": "Dejó de seguir al usuario"}), 200
+
+@api.route("/user/<int:user_id>/followers", methods=["GET"])
+def get_followers(user_id):
+    after, limit = page_args()
+    return users_page(get_graph().followers(user_id, after, limit), limit)
+
+@api.route("/user/<int:user_id>/following", methods=["GET"])
+def get_following(user_id):
+    after, limit = page_args()
+    return users_page(get_graph().following(user_id, after, limit), limit)
+
+@api.route("/user/<int:user_id>/mutuals", methods=["GET"])
+def get_mutuals(user_id):
+    after, limit = page_args()
+    return users_page(get_graph().mutuals(user_id, after, limit), limit)
+
+@api.route("/user/<int:user_id>/suggestions", methods=["GET"])
+def get_suggestions(user_id):
+    # Usuarios a los que siguen los usuarios que sigue, los más compartidos primero
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    suggestions = get_graph().suggestions(user_id, limit)
+    users = {user.id: user for user in User.query.filter(User.id.in_([id for id, _ in suggestions]), User.deleted_at.is_(None))}
+    return jsonify([
+        dict(users[id].serialize(), shared=shared) for id, shared in suggestions if id in users
+    ])
+
+# Historial de mensajes y notificaciones, las tablas recientes primero y luego el archivo
+def history_page(key, hot, archive, date_name, where):
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+    before = None
+    if request.args.get("before"):
+        try:
+            before = datetime.fromisoformat(request.args["before"])
+        except ValueError:
+            return jsonify({"error": "before debe ser una fecha ISO"}), 400
+    rows = history(hot, archive, date_name, where, before, request.args.get("before_id", type=int), limit)
+    last = rows[-1] if len(rows) == limit else None
+    return jsonify({
+        key: [row.serialize() for row in rows],
+        "next_before": getattr(last, date_name).isoformat() if last else None,
+        "next_before_id": last.id if last else None
+    })
+
+@api.route("/chat/<int:chat_id>/messages", methods=["GET"])
+def get_chat_messages(chat_id):
+    return history_page("messages", Message, MessageArchive, "sent_date", lambda model: [model.chat_id == chat_id])
+
+@api.route("/user/<int:user_id>/notifications", methods=["GET"])
+def get_notifications(user_id):
+    return history_page("notifications", Notification, NotificationArchive, "date", lambda model: [model.user_id == user_id])
+
 # Endpoints sobre ingredientes
 @api.route("/ingredients", methods=["GET"])
+@coalesce
 def get_ingredients():
     ingredients = Ingredient.query.all()
     return jsonify([ingredient.serialize() for ingredient in ingredients])
 
 @api.route("/ingredient/<int:Ingredient_id>", methods=["GET"])
+@coalesce
 def get_ingredient(Ingredient_id):
     ingredient = Ingredient.query.get_or_404(Ingredient_id)
     return jsonify(ingredient.serialize())
 
 @api.route("/ingredient", methods=["POST"])
+@idempotent
 def create_ingredient():
     data = request.json
     if not data:
@@ -111,14 +260,15 @@ def create_ingredient():
     if not ingredient_name:
         return jsonify({"error": "El nombre del ingrediente es obligatorio."}), 400
     
-    new_ingredient = Ingredient(
-        name=data.get("name"),
-        type=data.get("type")
-    )
-    
-    db.session.add(new_ingredient)
-    db.session.commit()
-    return jsonify(new_ingredient.serialize()), 201
+    # Si ya existe un ingrediente con ese nombre no se inserta y se devuelve el existente
+    try:
+        created = insert_or_ignore(Ingredient, {"name": ingredient_name, "type": data.get("type")}, ["name"])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "El tipo del ingrediente es obligatorio."}), 400
+    ingredient = Ingredient.query.filter_by(name=ingredient_name).one()
+    return jsonify(ingredient.serialize()), 201 if created else 200
 
 @api.route("/ingredient/<int:Ingredient_id>", methods=["PUT"])
 def update_ingredient(Ingredient_id):
@@ -158,6 +308,7 @@ def delete_ingredient(Ingredient_id):
  # endpoints cocktails
 
 @api.route("/cocktails", methods=["GET"])
+@coalesce
 def get_cocktails():
     # Obtiene todos los cócteles
     cocktails = Cocktail.query.all()
@@ -165,6 +316,7 @@ def get_cocktails():
 
 
 @api.route("/cocktail/<int:Cocktail_id>", methods=["GET"])
+@coalesce
 def get_cocktail(Cocktail_id):
     # Obtiene el cóctel por el id
     cocktail = Cocktail.query.get_or_404(Cocktail_id)
@@ -172,6 +324,7 @@ def get_cocktail(Cocktail_id):
 
 
 @api.route("/cocktail", methods=["POST"])
+@idempotent
 def create_cocktail():
     # Busca la data
     data = request.json
@@ -203,7 +356,13 @@ def create_cocktail():
     )
 
     db.session.add(new_cocktail)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # la clave foránea rechaza un user_id que no existe
+        db.session.rollback()
+        return jsonify({"Error": "Usuario no encontrado."}), 404
+    similarity.index_item("cocktail", new_cocktail)
     
     return jsonify(new_cocktail.serialize()), 201
 
@@ -225,6 +384,7 @@ def update_cocktail(Cocktail_id):
     cocktail.flavor_profile = data.get("flavor_profile", cocktail.flavor_profile)
     try:
         db.session.commit()
+        similarity.index_item("cocktail", cocktail)
         return jsonify({"Success": "Cóctel actualizado correctamente."}), 200
     except Exception as e:
         db.session.rollback()
@@ -233,14 +393,13 @@ def update_cocktail(Cocktail_id):
 
 @api.route("/cocktail/<int:Cocktail_id>", methods=["DELETE"])
 def delete_cocktail(Cocktail_id):
-    # Busca el cóctel
-    cocktail = Cocktail.query.get(Cocktail_id)
-    if not cocktail:
-        return jsonify({"Error": "Cóctel no encontrado."}), 404
     try:
-        # Elimina
-        db.session.delete(cocktail)
+        # Elimina sin cargarlo, favoritos y emparejamientos se borran con ON DELETE CASCADE
+        deleted = Cocktail.query.filter_by(id=Cocktail_id).delete(synchronize_session=False)
+        if not deleted:
+            return jsonify({"Error": "Cóctel no encontrado."}), 404
         db.session.commit()
+        similarity.unindex_item("cocktail", Cocktail_id)
     except Exception as e:
         db.session.rollback()
         return jsonify({"Error": str(e)}), 500
@@ -248,8 +407,22 @@ def delete_cocktail(Cocktail_id):
     return jsonify({"msg": "Cóctel eliminado correctamente."})
 
 
+@api.route("/cocktail/<int:Cocktail_id>/similar", methods=["GET"])
+def get_similar_cocktails(Cocktail_id):
+    # Los k cócteles más parecidos por nombre y preparación
+    k = min(max(request.args.get("k", 10, type=int), 1), 100)
+    matches = similarity.similar("cocktail", Cocktail_id, k)
+    if matches is None:
+        return jsonify({"Error": "Cóctel no encontrado."}), 404
+    cocktails = {cocktail.id: cocktail for cocktail in Cocktail.query.filter(Cocktail.id.in_([id for id, _ in matches]))}
+    return jsonify([
+        dict(cocktails[id].serialize(), score=score) for id, score in matches if id in cocktails
+    ])
+
+
 # endpoints platos
 @api.route("/dishes", methods=["GET"])
+@coalesce
 def get_dishes():
     # Obtiene todos los platos
     dishes = Dish.query.all()
@@ -257,6 +430,7 @@ def get_dishes():
 
 
 @api.route("/dish/<int:Dish_id>", methods=["GET"])
+@coalesce
 def get_dish(Dish_id):
     # Obtiene el plato por el id o da error
     dish = Dish.query.get_or_404(Dish_id)
@@ -264,6 +438,7 @@ def get_dish(Dish_id):
 
 
 @api.route("/dish", methods=["POST"])
+@idempotent
 def post_dish():
     data = request.json
     if not data:
@@ -278,7 +453,12 @@ def post_dish():
         flavor_profile=data.get("flavor_profile")
     )
     db.session.add(new_dish)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"Error": "Faltan datos obligatorios del plato."}), 400
+    similarity.index_item("dish", new_dish)
     return jsonify(new_dish.serialize())
 
 
@@ -298,6 +478,7 @@ def update_dish(Dish_id):
     dish.flavor_profile = data.get("flavor_profile", dish.flavor_profile)
     try:
         db.session.commit()
+        similarity.index_item("dish", dish)
         return jsonify({"Success": "Plato actualizado correctamente."}), 200
     except Exception as e:
         db.session.rollback()
@@ -306,14 +487,13 @@ def update_dish(Dish_id):
 
 @api.route("/dish/<int:Dish_id>", methods=["DELETE"])
 def delete_dish(Dish_id):
-    # Obtiene plato por id
-    dish = Dish.query.get(Dish_id)
-    if not dish:
-        return jsonify({"Error": "Plato no encontrado."}), 404
     try:
-        # Elimina
-        db.session.delete(dish)
+        # Elimina sin cargarlo, favoritos y emparejamientos se borran con ON DELETE CASCADE
+        deleted = Dish.query.filter_by(id=Dish_id).delete(synchronize_session=False)
+        if not deleted:
+            return jsonify({"Error": "Plato no encontrado."}), 404
         db.session.commit()
+        similarity.unindex_item("dish", Dish_id)
     except Exception as e:
         db.session.rollback()
         return jsonify({"Error": str(e)}), 500
@@ -321,6 +501,19 @@ def delete_dish(Dish_id):
     return jsonify({"msg": "Plato eliminado correctamente."})
 
 
+@api.route("/dish/<int:Dish_id>/similar", methods=["GET"])
+def get_similar_dishes(Dish_id):
+    # Los k platos más parecidos por nombre y preparación
+    k = min(max(request.args.get("k", 10, type=int), 1), 100)
+    matches = similarity.similar("dish", Dish_id, k)
+    if matches is None:
+        return jsonify({"Error": "Plato no encontrado."}), 404
+    dishes = {dish.id: dish for dish in Dish.query.filter(Dish.id.in_([id for id, _ in matches]))}
+    return jsonify([
+        dict(dishes[id].serialize(), score=score) for id, score in matches if id in dishes
+    ])
+
+
 # endpoints favoritos
 @api.route("/favorites", methods=["GET"])
 def get_favourites():
@@ -337,6 +530,7 @@ def get_favorite(favorite_id):
 
 
 @api.route("/favorite", methods=["POST"])
+@idempotent
 def create_favorite():
     # Convierte la data a json
     data = request.json
@@ -353,21 +547,21 @@ def create_favorite():
     if cocktail_id and dish_id:
         return jsonify({"Error": "Solo puedes marcar como favorito un plato o un cóctel, no ambos."}), 400
 
-    # Crear el favorito
-    new_favorite = Favorite(
-        user_id=user_id,
-        cocktail_id=cocktail_id,
-        dish_id=dish_id
-    )
-
+    # Crear el favorito, si ya estaba guardado se devuelve el existente
+    conflict_columns = ["user_id", "cocktail_id"] if cocktail_id else ["user_id", "dish_id"]
     try:
-        db.session.add(new_favorite)
+        created = insert_or_ignore(Favorite, {
+            "user_id": user_id,
+            "cocktail_id": cocktail_id,
+            "dish_id": dish_id
+        }, conflict_columns)
         db.session.commit()
-        return jsonify(new_favorite.serialize()), 201
+        favorite = Favorite.query.filter_by(user_id=user_id, cocktail_id=cocktail_id, dish_id=dish_id).one()
+        return jsonify(favorite.serialize()), 201 if created else 200
     except Exception as e:
         db.session.rollback()
         # Agregar el logging del error
-        logging.exception("Ocurrió un error durante la creación del favorito.")
+        logger.exception("Ocurrió un error durante la creación del favorito.")
         # Devolver el mensaje de error exacto
         return jsonify({"Error": str(e)}), 500
 
@@ -403,7 +597,7 @@ def update_favorite(fav_id):
     except Exception as e:
         db.session.rollback()
         # Registrar el error para depuración
-        logging.error("Error al guardar en la base de datos: %s", str(e))
+        logger.error("Error al guardar en la base de datos: %s", str(e))
         return jsonify({"Error": str(e)}), 500
 
 
@@ -441,6 +635,7 @@ def get_pairing(pairing_id):
 
 
 @api.route("/pairing", methods=["POST"])
+@idempotent
 def create_pairing():
     data = request.get_json()
 
@@ -454,7 +649,12 @@ def create_pairing():
     new_pairing = Pairing(user_id=user_id, cocktail_id=cocktail_id, dish_id=dish_id)
 
     db.session.add(new_pairing)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # la clave foránea rechaza un usuario, cóctel o plato que no existe
+        db.session.rollback()
+        return jsonify({'error': 'Usuario, cóctel o plato no encontrado'}), 404
 
     return jsonify(new_pairing.serialize()), 201
 
@@ -472,7 +672,12 @@ def update_pairing(pairing_id):
     if 'dish_id' in data:
         pairing.dish_id = data['dish_id']
 
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # la clave foránea rechaza un usuario, cóctel o plato que no existe
+        db.session.rollback()
+        return jsonify({'error': 'Usuario, cóctel o plato no encontrado'}), 404
 
     return jsonify(pairing.serialize()), 200
 
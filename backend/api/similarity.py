@@ -0,0 +1,238 @@
+"""
+"More like this" for cocktails and dishes.
+
+The name and preparation steps of every item are turned into a vector of hashed word
+and character trigram counts (the hashing trick: no vocabulary to keep, a fixed
+SIMILARITY_DIM size), log scaled and normalized. The vectors of all the items of a kind
+live in one float32 matrix, so the top K similar items are a single matrix-vector
+product and a partial sort.
+
+Each worker keeps the indexes of its app in app.extensions['similarity']: built by a
+background thread after the first query, which is answered 503 until it is done (or at
+startup with SIMILARITY_PRELOAD, before gunicorn forks, so the workers share its memory),
+updated by the writes of the worker, catching up with the rows other workers inserted
+every SIMILARITY_REFRESH_SECONDS and rebuilt in the background every
+SIMILARITY_REBUILD_SECONDS while the old vectors keep answering.
+
+NumPy is imported on first use, workers that never serve these endpoints don't load it.
+"""
+import logging
+import re
+import threading
+import time
+import zlib
+
+from flask import current_app
+
+from api.models import db, Cocktail, Dish
+from api.utils import APIException
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"\w+")
+# the name says more about an item than the steps
+NAME_WEIGHT = 2.0
+BUILD_CHUNK_SIZE = 5000
+
+
+def features(text):
+    for word in WORD.findall(text.lower()):
+        yield word
+        padded = f"<{word}>"
+        for start in range(len(padded) - 2):
+            yield padded[start:start + 3]
+
+
+def vectorize(name, preparation_steps, dim):
+    import numpy as np
+    vector = np.zeros(dim, dtype=np.float32)
+    for text, weight in ((name or "", NAME_WEIGHT), (preparation_steps or "", 1.0)):
+        hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in features(text)), dtype=np.int64)
+        if not len(hashes):
+            continue
+        # the hash bits above the bucket decide the sign, so collisions cancel out on average
+        signs = np.where((hashes // dim) % 2 == 0, weight, -weight).astype(np.float32)
+        np.add.at(vector, hashes % dim, signs)
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class Vectors:
+    """The vectors of one kind of item, one row per item."""
+
+    def __init__(self, dim):
+        import numpy as np
+        self.dim = dim
+        self.ids = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, dim), dtype=np.float32)
+        self.size = 0
+        self.rows = {}
+        self.max_id = 0
+
+    def set(self, item_id, vector):
+        import numpy as np
+        row = self.rows.get(item_id)
+        if row is None:
+            if self.size == len(self.ids):
+                # grow by doubling, appends stay amortized O(1)
+                capacity = max(1024, 2 * len(self.ids))
+                ids = np.full(capacity, -1, dtype=np.int64)
+                ids[:self.size] = self.ids[:self.size]
+                matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+                matrix[:self.size] = self.matrix[:self.size]
+                self.ids, self.matrix = ids, matrix
+            row = self.rows[item_id] = self.size
+            self.ids[row] = item_id
+            self.size += 1
+        self.matrix[row] = vector
+        self.max_id = max(self.max_id, item_id)
+
+    def remove(self, item_id):
+        row = self.rows.pop(item_id, None)
+        if row is not None:
+            # the row stays, with no id and a null vector it never matches
+            self.ids[row] = -1
+            self.matrix[row] = 0
+
+
+class SimilarityIndex:
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.dim = None
+        self.vectors = None
+        self.built_at = None
+        self.refreshed_at = None
+        self.builder = None
+        # writes received while a build runs, replayed on the new vectors
+        self.pending = None
+
+    def _items(self):
+        return db.select(self.model.id, self.model.name, self.model.preparation_steps).order_by(self.model.id)
+
+    def _load(self, vectors, query):
+        for item_id, name, steps in db.session.execute(query).yield_per(BUILD_CHUNK_SIZE):
+            vectors.set(item_id, vectorize(name, steps, vectors.dim))
+
+    def _build(self, app, dim):
+        started = time.monotonic()
+        vectors = Vectors(dim)
+        with app.app_context():
+            try:
+                self._load(vectors, self._items())
+            except Exception:
+                logger.exception("Build of the %s similarity index failed", self.model.__tablename__)
+                with self.lock:
+                    self.pending = None
+                return
+        with self.lock:
+            for write in self.pending:
+                write(vectors)
+            self.vectors, self.pending = vectors, None
+            self.built_at = self.refreshed_at = started
+
+    def refresh(self, app, dim, rebuild_after, catch_up_after):
+        """
+        Start a build in a background thread when there are no vectors yet or they are
+        older than rebuild_after, catch up with the rows inserted since catch_up_after.
+        Returns whether the index can answer.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.builder is not None and self.builder.is_alive():
+                return self.vectors is not None
+            # a build thread doesn't survive a fork, its writes are read again by the next build
+            self.pending = None
+            if self.vectors is None or now - self.built_at > rebuild_after:
+                self.dim, self.pending = dim, []
+                self.builder = threading.Thread(
+                    target=self._build, args=(app, dim), daemon=True, name=f"similarity-{self.model.__tablename__}"
+                )
+                self.builder.start()
+            elif now - self.refreshed_at > catch_up_after:
+                # rows inserted by the other workers
+                self._load(self.vectors, self._items().where(self.model.id > self.vectors.max_id))
+                self.refreshed_at = now
+            return self.vectors is not None
+
+    def _write(self, write):
+        with self.lock:
+            if self.vectors is not None:
+                write(self.vectors)
+            if self.pending is not None:
+                self.pending.append(write)
+
+    def upsert(self, item_id, name, preparation_steps):
+        # nothing to do before the first build starts, it will read the item from the database
+        if self.vectors is not None or self.pending is not None:
+            vector = vectorize(name, preparation_steps, self.dim)
+            self._write(lambda vectors: vectors.set(item_id, vector))
+
+    def remove(self, item_id):
+        self._write(lambda vectors: vectors.remove(item_id))
+
+    def similar(self, item_id, k):
+        """Return [(id, score)] of the k most similar items, or None if item_id isn't indexed."""
+        import numpy as np
+        with self.lock:
+            vectors = self.vectors
+            row = vectors.rows.get(item_id) if vectors is not None else None
+            if row is None:
+                return None
+            ids, matrix, size = vectors.ids, vectors.matrix, vectors.size
+        scores = matrix[:size] @ matrix[row]
+        scores[row] = -np.inf
+        scores[ids[:size] < 0] = -np.inf
+        k = min(k, size - 1)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if scores[i] > -np.inf]
+
+
+def get_index(kind):
+    """Return the index of kind of the current app, refreshed first when needed. 503 until it is built."""
+    config = current_app.config
+    index = current_app.extensions['similarity'][kind]
+    ready = index.refresh(
+        current_app._get_current_object(),
+        config.get('SIMILARITY_DIM', 128),
+        config.get('SIMILARITY_REBUILD_SECONDS', 3600),
+        config.get('SIMILARITY_REFRESH_SECONDS', 30),
+    )
+    if not ready:
+        raise APIException("El índice de similares se está construyendo, inténtalo más tarde.", status_code=503)
+    return index
+
+
+def similar(kind, item_id, k=10):
+    """Return [(id, score)] of the k items most similar to item_id, or None if it doesn't exist."""
+    index = get_index(kind)
+    matches = index.similar(item_id, k)
+    if matches is None:
+        # inserted by another worker since the last catch up, or below max_id: index it now
+        item = db.session.get(index.model, item_id)
+        if item is None:
+            return None
+        index.upsert(item.id, item.name, item.preparation_steps)
+        matches = index.similar(item_id, k)
+    return matches
+
+
+def index_item(kind, item):
+    current_app.extensions['similarity'][kind].upsert(item.id, item.name, item.preparation_steps)
+
+
+def unindex_item(kind, item_id):
+    current_app.extensions['similarity'][kind].remove(item_id)
+
+
+def setup_similarity(app):
+    indexes = app.extensions['similarity'] = {"cocktail": SimilarityIndex(Cocktail), "dish": SimilarityIndex(Dish)}
+    if app.config.get('SIMILARITY_PRELOAD'):
+        # built before gunicorn forks, so no build thread is left running
+        for index in indexes.values():
+            index.refresh(app, app.config.get('SIMILARITY_DIM', 128), 0, 0)
+            index.builder.join()
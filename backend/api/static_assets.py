@@ -0,0 +1,171 @@
+"""
+Static asset pipeline for the frontend bundle and compression of API responses.
+
+In manifest mode every file under the public folder is read once at startup:
+its bytes, a content hash and the gzip/brotli variants are kept in memory, so
+serving an asset never touches the filesystem. Each asset is also published
+under a content-hashed name (main.js -> main.1a2b3c4d5e.js) that is cached
+forever by the browser, and the html files are rewritten to point to them.
+"""
+import copy
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# main.3f2a9c1b.js, 2.a1b2c3d4.chunk.js... files that already carry their hash
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/xml",
+    "image/svg+xml",
+)
+REFERENCE = re.compile(r"""(src|href)=(["'])/?([^"'?#:]+)\2""")
+
+
+def _is_compressible(mimetype):
+    return any(mimetype.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def _accepted_encodings():
+    # Preferred order: brotli compresses text better than gzip
+    available = ("br", "gzip") if brotli is not None else ("gzip",)
+    return [enc for enc in available if request.accept_encodings[enc] > 0]
+
+
+def _compress(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+class Asset:
+    __slots__ = ("path", "mimetype", "etag", "immutable", "variants")
+
+    def __init__(self, path, body, immutable):
+        self.path = path
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.immutable = immutable
+        # encoding -> bytes, None is the identity encoding
+        self.variants = {None: body}
+        if _is_compressible(self.mimetype):
+            for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+                # Build time, so use the best compression level available
+                compressed = _compress(body, encoding, 11 if encoding == "br" else 9)
+                if len(compressed) < len(body):
+                    self.variants[encoding] = compressed
+
+    def send(self):
+        encoding = next((enc for enc in _accepted_encodings() if enc in self.variants), None)
+        response = Response(self.variants[encoding], mimetype=self.mimetype)
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        if len(self.variants) > 1:
+            response.vary.add("Accept-Encoding")
+        response.set_etag(self.etag if encoding is None else f"{self.etag}-{encoding}")
+        response.headers["Cache-Control"] = IMMUTABLE if self.immutable else REVALIDATE
+        return response.make_conditional(request)
+
+
+class AssetManifest:
+    """In-memory copy of the public folder, keyed by url path."""
+
+    def __init__(self, root, index="index.html"):
+        self.root = root
+        self.index = index
+        self.assets = {}
+        self.hashed_names = {}
+
+    def build(self):
+        files = {}
+        if os.path.isdir(self.root):
+            for folder, _, names in os.walk(self.root):
+                for name in names:
+                    full_path = os.path.join(folder, name)
+                    path = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+                    with open(full_path, "rb") as f:
+                        files[path] = f.read()
+
+        # Files without a hash in their name get a hashed alias served with immutable caching
+        for path, body in files.items():
+            if path.endswith(".html") or HASHED_NAME.search(os.path.basename(path)):
+                continue
+            stem, ext = os.path.splitext(path)
+            digest = hashlib.sha256(body).hexdigest()[:10]
+            self.hashed_names[path] = f"{stem}.{digest}{ext}"
+
+        for path, body in files.items():
+            if path.endswith(".html"):
+                body = self._rewrite_references(body)
+            immutable = bool(HASHED_NAME.search(os.path.basename(path)))
+            asset = self.assets[path] = Asset(path, body, immutable)
+            if path in self.hashed_names:
+                # Same bytes and variants, only the caching policy changes
+                alias = copy.copy(asset)
+                alias.immutable = True
+                self.assets[self.hashed_names[path]] = alias
+        return self
+
+    def _rewrite_references(self, html):
+        def replace(match):
+            attribute, quote, path = match.groups()
+            if path not in self.hashed_names:
+                return match.group(0)
+            return f"{attribute}={quote}/{self.hashed_names[path]}{quote}"
+
+        return REFERENCE.sub(replace, html.decode("utf-8")).encode("utf-8")
+
+    def url_for(self, path):
+        path = path.lstrip("/")
+        return "/" + self.hashed_names.get(path, path)
+
+    def serve(self, path):
+        # Unknown paths are client side routes of the SPA
+        asset = self.assets.get(path) or self.assets.get(self.index)
+        if asset is None:
+            return Response("Not Found", status=404)
+        return asset.send()
+
+
+def setup_compression(app):
+    """Compress JSON responses above COMPRESS_MIN_SIZE bytes when the client accepts it."""
+    min_size = app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    level = app.config.setdefault("COMPRESS_LEVEL", 6)
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers
+            or not 200 <= response.status_code < 300
+        ):
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encodings = _accepted_encodings()
+        if not encodings:
+            return response
+        # A mid compression level, the best ones are too slow for per-request work
+        response.set_data(_compress(data, encodings[0], level))
+        response.headers["Content-Encoding"] = encodings[0]
+        return response
@@ -1,4 +1,7 @@
-from flask import jsonify, url_for
+import hmac
+import threading
+from functools import wraps
+from flask import Flask, current_app, jsonify, request, url_for
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +18,20 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def is_admin():
+    # The admin endpoints are closed unless an ADMIN_TOKEN is configured
+    token = current_app.config.get('ADMIN_TOKEN')
+    given = request.headers.get('X-Admin-Token', '')
+    return bool(token) and hmac.compare_digest(given.encode(), token.encode())
+
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            raise APIException("Admin token required", status_code=403)
+        return view(*args, **kwargs)
+    return wrapper
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
@@ -39,3 +56,41 @@ def generate_sitemap(app):
         <p>Start working on your project by following the <a href="https://start.4geeksacademy.com/starters/full-stack" target="_blank">Quick Start</a></p>
         <p>Remember to specify a real endpoint path like: </p>
         <ul style="text-align: left;">"""+links_html+"</ul></div>"
+
+class LazyAdmin:
+    """
+    WSGI middleware that builds the Flask-Admin app the first time /admin is requested,
+    so workers that never serve the admin don't pay for importing and registering it.
+    Flask doesn't allow registering blueprints once it has served a request, so the
+    admin runs in its own Flask app sharing the configuration and the engine, and so
+    the connection pool, of the main app.
+    """
+    def __init__(self, app, wsgi_app, url='/admin'):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.url = url
+        self.admin_app = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == self.url or path.startswith(self.url + '/'):
+            return self.get_admin_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def get_admin_app(self):
+        with self.lock:
+            if self.admin_app is None:
+                from sqlalchemy.orm import scoped_session, sessionmaker
+                from api.admin import setup_admin
+                from api.models import db
+
+                admin_app = Flask(self.app.import_name, static_folder=None)
+                admin_app.config.update(self.app.config)
+                # db.init_app would give the admin an engine and a pool of its own
+                with self.app.app_context():
+                    session = scoped_session(sessionmaker(bind=db.engine))
+                admin_app.teardown_appcontext(lambda error: session.remove())
+                setup_admin(admin_app, session)
+                self.admin_app = admin_app
+        return self.admin_app
@@ -1,77 +1,240 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
+import logging.config
 import os
-from flask import Flask, request, jsonify, url_for, send_from_directory
+import weakref
+from flask import Flask, jsonify, send_from_directory
 from flask_migrate import Migrate
-from flask_swagger import swagger
-from api.utils import APIException, generate_sitemap
+from werkzeug.middleware.proxy_fix import ProxyFix
+from api.utils import APIException, LazyAdmin, generate_sitemap
 from api.models import db
 from api.routes import api
-from api.admin import setup_admin
 from api.commands import setup_commands
+from api.static_assets import AssetManifest, setup_compression
+from api.profiling import setup_profiling
+from api.analytics import analytics
+from api.similarity import setup_similarity
+from api.graph import setup_graph
 
 # from models import Person
 
 ENV = "development" if os.getenv("FLASK_DEBUG") == "1" else "production"
 static_file_dir = os.path.join(os.path.dirname(
     os.path.realpath(__file__)), '../public/')
-app = Flask(__name__)
 
 
+def default_config():
+    config = {}
+
+    # database condiguration
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
+            "postgres://", "postgresql://")
+    else:
+        config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+        # pool sized per worker: one connection per thread plus a small overflow, so the
+        # whole deployment needs workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            "pool_size": int(os.getenv("DB_POOL_SIZE", os.getenv("WEB_THREADS", 4))),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 2)),
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        }
+
+    config['LOG_LEVEL'] = os.getenv("LOG_LEVEL", "DEBUG" if ENV == "development" else "INFO")
+
+    # feature toggles, API-only deployments can turn everything off to boot faster
+    # admin: "on" loads it at startup, "lazy" on the first /admin request, "off" never
+    config['FEATURE_ADMIN'] = os.getenv("FEATURE_ADMIN", "lazy")
+    config['FEATURE_SWAGGER'] = os.getenv("FEATURE_SWAGGER", "1" if ENV == "development" else "0") == "1"
+    config['FEATURE_SITEMAP'] = os.getenv("FEATURE_SITEMAP", "1" if ENV == "development" else "0") == "1"
+
+    # "async" marks deleted users and purges their data in background batches, "sync" deletes at once
+    config['USER_DELETE_MODE'] = os.getenv("USER_DELETE_MODE", "async")
+    config['PURGE_BATCH_SIZE'] = int(os.getenv("PURGE_BATCH_SIZE", 1000))
+
+    # identical GETs in flight share one computation, and the response is reused for
+    # this many seconds before a single request refreshes it (0 disables the window)
+    config['COALESCE_STALE_SECONDS'] = float(os.getenv("COALESCE_STALE_SECONDS", 0))
+
+    # how long the responses of requests sent with an Idempotency-Key are replayed
+    config['IDEMPOTENCY_TTL'] = int(os.getenv("IDEMPOTENCY_TTL", 86400))
+    # "database" shares the keys between the workers, "memory" keeps them in each worker
+    config['IDEMPOTENCY_STORE'] = os.getenv("IDEMPOTENCY_STORE", "database")
+    # a key whose request hasn't finished is held this long, the worker timeout: a worker
+    # killed mid-request frees it then instead of after IDEMPOTENCY_TTL
+    config['IDEMPOTENCY_PENDING_SECONDS'] = int(os.getenv("IDEMPOTENCY_PENDING_SECONDS", os.getenv("WEB_TIMEOUT", 30)))
+
+    # similar cocktails and dishes: size of the vectors, and when each worker's index
+    # catches up with the other workers' inserts and is rebuilt from scratch
+    config['SIMILARITY_DIM'] = int(os.getenv("SIMILARITY_DIM", 128))
+    config['SIMILARITY_REFRESH_SECONDS'] = int(os.getenv("SIMILARITY_REFRESH_SECONDS", 30))
+    config['SIMILARITY_REBUILD_SECONDS'] = int(os.getenv("SIMILARITY_REBUILD_SECONDS", 3600))
+    # build the indexes at startup, before gunicorn forks, so the workers share them
+    config['SIMILARITY_PRELOAD'] = os.getenv("SIMILARITY_PRELOAD", "0") == "1"
+
+    # each worker rebuilds its follow graph index this often to see the other workers' follows
+    config['GRAPH_REBUILD_SECONDS'] = int(os.getenv("GRAPH_REBUILD_SECONDS", 300))
+    # build it at startup, before gunicorn forks, so new workers don't wait for it
+    config['GRAPH_PRELOAD'] = os.getenv("GRAPH_PRELOAD", "0") == "1"
+
+    # messages and notifications older than this move to the archive tables with `flask archive`,
+    # the archived ones are dropped after ARCHIVE_RETENTION_DAYS (0 keeps them forever)
+    config['RETENTION_DAYS'] = int(os.getenv("RETENTION_DAYS", 90))
+    config['ARCHIVE_RETENTION_DAYS'] = int(os.getenv("ARCHIVE_RETENTION_DAYS", 0))
+    config['ARCHIVE_BATCH_SIZE'] = int(os.getenv("ARCHIVE_BATCH_SIZE", 5000))
+
+    # requests per minute of each client: in total, and on each route by kind of route.
+    # The client is the address of the peer: behind a proxy or load balancer set PROXY_HOPS,
+    # otherwise every client shares the bucket of the proxy's address
+    config['RATE_LIMIT'] = os.getenv("RATE_LIMIT", "1") == "1"
+    config['RATE_LIMIT_CLIENT'] = int(os.getenv("RATE_LIMIT_CLIENT", 1200))
+    config['RATE_LIMIT_WRITE'] = int(os.getenv("RATE_LIMIT_WRITE", 60))
+    config['RATE_LIMIT_LIST'] = int(os.getenv("RATE_LIMIT_LIST", 60))
+    config['RATE_LIMIT_READ'] = int(os.getenv("RATE_LIMIT_READ", 600))
+    # number of proxies in front of the app: the client address is taken that many entries
+    # from the right of X-Forwarded-For, the entries to their left are set by the client
+    config['PROXY_HOPS'] = int(os.getenv("PROXY_HOPS", 0))
+    # requests a worker serves at once, past it they get a 503 (0 is no limit). A gthread
+    # worker never runs more than WEB_THREADS requests, the others wait in its queue (see
+    # worker_connections in gunicorn.conf.py), so a cap of WEB_THREADS or more would never
+    # be reached: by default one less than the threads (and the pool's connections), the
+    # last thread answers the queued requests 503 at once while the others are busy
+    pool = config.get('SQLALCHEMY_ENGINE_OPTIONS')
+    threads = int(os.getenv("WEB_THREADS", 4))
+    config['API_MAX_CONCURRENCY'] = int(os.getenv(
+        "API_MAX_CONCURRENCY", max(1, min(threads, pool["pool_size"] + pool["max_overflow"]) - 1) if pool else 0
+    ))
+    config['ADMISSION_WAIT_SECONDS'] = float(os.getenv("ADMISSION_WAIT_SECONDS", 0))
+
+    # token expected in the X-Admin-Token header by the admin-only endpoints
+    config['ADMIN_TOKEN'] = os.getenv("ADMIN_TOKEN")
+    # request profiling: PROFILING=1 enables it, triggered by the X-Profile header or a sample rate
+    config['PROFILING'] = os.getenv("PROFILING", "0") == "1"
+    config['PROFILING_SAMPLE_RATE'] = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+
+    # serve the frontend from an in-memory manifest with precompressed, content-hashed assets
+    config['STATIC_MANIFEST'] = os.getenv("STATIC_MANIFEST", "0" if ENV == "development" else "1") == "1"
+    # compress big JSON responses
+    config['COMPRESS_MIN_SIZE'] = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+    return config
+
+
+def configure_logging(level):
+    logging.config.dictConfig({
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {
+            # the pid tells the workers apart
+            "default": {"format": "%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s"},
+        },
+        "handlers": {
+            "stderr": {"class": "logging.StreamHandler", "stream": "ext://sys.stderr", "formatter": "default"},
+        },
+        "root": {"level": level.upper(), "handlers": ["stderr"]},
+    })
+
+
+# apps whose database pool a forked worker must drop, without keeping them alive
+_live_apps = weakref.WeakSet()
+
+
+def _dispose_engines():
+    # A forked worker must not reuse the connections its parent opened: drop the
+    # inherited pools (without closing the parent's sockets) and start new ones
+    for app in list(_live_apps):
+        with app.app_context():
+            db.engine.dispose(close=False)
+
+
+# registered once, os.register_at_fork hooks can't be removed
+os.register_at_fork(after_in_child=_dispose_engines)
+
+
+def setup_fork_safety(app):
+    _live_apps.add(app)
+
+
+def create_app(config=None):
+    # the bundle lives in static_file_dir, so the default /static route would only shadow it
+    app = Flask(__name__, static_folder=None)
+    app.url_map.strict_slashes = False
+    app.config.update(default_config())
+    if config is not None:
+        app.config.update(config)
+
+    configure_logging(app.config['LOG_LEVEL'])
+
+    Migrate(app, db, compare_type=True)
+    db.init_app(app)
+    setup_fork_safety(app)
+
+    # add the admin
+    if app.config['FEATURE_ADMIN'] == "on":
+        from api.admin import setup_admin
+        setup_admin(app)
+    elif app.config['FEATURE_ADMIN'] == "lazy":
+        app.wsgi_app = LazyAdmin(app, app.wsgi_app)
+
+    # remote_addr is the client's address behind the trusted proxies
+    if app.config['PROXY_HOPS']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+
+    # add the commands
+    setup_commands(app)
+
+    setup_profiling(app)
+
+    # Add all endpoints form the API with a "api" prefix
+    app.register_blueprint(api, url_prefix='/api')
+    app.register_blueprint(analytics, url_prefix='/api/analytics')
+
+    setup_compression(app)
+    setup_similarity(app)
+    setup_graph(app)
+
+    assets = AssetManifest(static_file_dir).build() if app.config['STATIC_MANIFEST'] else None
+
+    # Handle/serialize errors like a JSON object
+    @app.errorhandler(APIException)
+    def handle_invalid_usage(error):
+        return jsonify(error.to_dict()), error.status_code
+
+    if app.config['FEATURE_SWAGGER']:
+        @app.route('/swagger.json')
+        def swagger_spec():
+            from flask_swagger import swagger
+            return jsonify(swagger(app))
+
+    # generate sitemap with all your endpoints
+    @app.route('/')
+    def sitemap():
+        if app.config['FEATURE_SITEMAP']:
+            return generate_sitemap(app)
+        if assets is not None:
+            return assets.serve('index.html')
+        return send_from_directory(static_file_dir, 'index.html')
+
+    # any other endpoint will try to serve it like a static file
+    @app.route('/<path:path>', methods=['GET'])
+    def serve_any_other_file(path):
+        if assets is not None:
+            return assets.serve(path)
+        if not os.path.isfile(os.path.join(static_file_dir, path)):
+            path = 'index.html'
+        response = send_from_directory(static_file_dir, path)
+        response.cache_control.max_age = 0  # avoid cache memory
+        return response
 
-app.url_map.strict_slashes = False
+    return app
 
-# database condiguration
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
-        "postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db, compare_type=True)
-db.init_app(app)
-
-# add the admin
-setup_admin(app)
-
-# add the admin
-setup_commands(app)
-
-# Add all endpoints form the API with a "api" prefix
-app.register_blueprint(api, url_prefix='/api')
-
-# Handle/serialize errors like a JSON object
-
-
-@app.errorhandler(APIException)
-def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
-
-# generate sitemap with all your endpoints
-
-
-@app.route('/')
-def sitemap():
-    if ENV == "development":
-        return generate_sitemap(app)
-    return send_from_directory(static_file_dir, 'index.html')
-
-# any other endpoint will try to serve it like a static file
-
-
-@app.route('/<path:path>', methods=['GET'])
-def serve_any_other_file(path):
-    if not os.path.isfile(os.path.join(static_file_dir, path)):
-        path = 'index.html'
-    response = send_from_directory(static_file_dir, path)
-    response.cache_control.max_age = 0  # avoid cache memory
-    return response
-
-
-# this only runs if `$ python src/main.py` is executed
+# this only runs if `$ python src/main.py` is executed,
+# `flask` finds create_app by itself and gunicorn uses gunicorn.conf.py
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3001))
-    app.run(host='0.0.0.0', port=PORT, debug=True)
+    create_app().run(host='0.0.0.0', port=PORT, debug=True)
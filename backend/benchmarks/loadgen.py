@@ -0,0 +1,97 @@
+"""
+Small HTTP load generator: several processes, each with a few keep-alive connections,
+so the generator itself is not limited by the GIL of a single interpreter.
+"""
+import http.client
+import itertools
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _connection_loop(host, port, method, next_request, headers, deadline, latencies, errors):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    while time.perf_counter() < deadline:
+        item = next_request()
+        if item is None:
+            break
+        path, body = item
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors.append(response.status)
+            else:
+                latencies.append(time.perf_counter() - start)
+        except (OSError, http.client.HTTPException):
+            errors.append(0)
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+    connection.close()
+
+
+def _process_loop(url, method, requests, repeat, headers, connections, duration):
+    parts = urlsplit(url)
+    # the clients of the process take the requests in turn
+    lock = threading.Lock()
+    items = itertools.cycle(requests) if repeat else iter(requests)
+
+    def next_request():
+        with lock:
+            return next(items, None)
+
+    started = time.perf_counter()
+    deadline = started + duration
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=_connection_loop, args=(
+            parts.hostname, parts.port, method, next_request, headers, deadline, latencies, errors))
+        for _ in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def run_load(url, duration=10, processes=2, connections=4, method="GET", body=None, headers=None,
+             requests=None, repeat=True):
+    """
+    Hit url for duration seconds with processes * connections concurrent clients. With
+    requests, a list of (path, body), the clients send those to the host of url instead,
+    each once unless repeat, and stop early when they run out.
+    """
+    headers = headers or {}
+    if requests is None:
+        parts = urlsplit(url)
+        requests = [(parts.path + ("?" + parts.query if parts.query else ""), body)]
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [
+            pool.submit(_process_loop, url, method, requests[index::processes], repeat, headers, connections, duration)
+            for index in range(processes)
+        ]
+        results = [future.result() for future in futures]
+
+    latencies = [latency for process_latencies, _, _ in results for latency in process_latencies]
+    errors = sum(len(process_errors) for _, process_errors, _ in results)
+    elapsed = max(process_elapsed for _, _, process_elapsed in results)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
@@ -0,0 +1,245 @@
+"""
+Benchmarks every endpoint of the api blueprint against a seeded database.
+
+    $ python -m benchmarks.run --rows 10000 --save-baseline benchmarks/baseline.json
+    $ python -m benchmarks.run --rows 10000 --http --check benchmarks/baseline.json
+
+Every endpoint runs through the Flask test client, which records latency percentiles,
+throughput, SQL queries per request and the peak Python memory of one request. With
+--http every endpoint is also loaded through gunicorn with a real HTTP client: the
+reads and updates repeat one request, the creates and deletes send distinct ones.
+--check compares the report with a baseline and fails on regressions.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+import click
+from sqlalchemy import event
+
+from api.models import db
+from benchmarks.loadgen import percentile, run_load
+from benchmarks.scenarios import SCENARIOS, Fixtures
+from benchmarks.seed import seed
+from benchmarks.worker_scaling import free_port, wait_until_ready, BACKEND_DIR
+
+# the requests of these methods can be sent again with the same result, the others are
+# sent once each over HTTP: iterations times this many, at most a quarter of the rows
+IDEMPOTENT_METHODS = ("GET", "PUT")
+HTTP_WRITES_PER_ITERATION = 10
+# GET endpoints returning whole tables get fewer iterations
+LIST_ENDPOINTS = {"api.get_users", "api.get_ingredients", "api.get_cocktails", "api.get_dishes",
+                  "api.get_favourites", "api.get_pairings"}
+
+
+@contextmanager
+def counting_queries(app):
+    queries = Counter()
+    # the test client serves the requests in this thread, background work such as the
+    # purge of deleted users runs in other threads and isn't the endpoint's cost
+    thread = threading.get_ident()
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread:
+            queries["total"] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def api_routes(app):
+    for rule in app.url_map.iter_rules():
+        if not rule.endpoint.startswith("api."):
+            continue
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"}):
+            yield rule, method
+
+
+def bench_test_client(app, fixtures, rule, method, iterations):
+    client = app.test_client()
+    urls = app.url_map.bind("localhost")
+    scenario = SCENARIOS[(rule.endpoint, method)]
+
+    def request():
+        kwargs, body = scenario(fixtures)
+        return client.open(urls.build(rule.endpoint, kwargs, method=method), method=method, json=body)
+
+    # first request outside of the measures, it warms up caches and lazy imports. The
+    # in-memory indexes answer 503 until their background build is done
+    deadline = time.monotonic() + 600
+    while request().status_code == 503 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    latencies, statuses = [], Counter()
+    with counting_queries(app) as queries:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            statuses[request().status_code] += 1
+            latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+
+    # memory is measured apart, tracemalloc slows everything down
+    tracemalloc.start()
+    request()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "throughput": iterations / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries_per_request": queries["total"] / iterations,
+        "peak_memory_kb": peak_memory / 1024,
+        "statuses": {str(status): count for status, count in statuses.items()},
+    }
+
+
+@contextmanager
+def http_server(database_url, workers):
+    port = free_port()
+    # the load comes from a single client, it would only measure the rate limits
+    env = dict(os.environ, DATABASE_URL=database_url, PORT=str(port),
+               WEB_CONCURRENCY=str(workers), LOG_LEVEL="warning", RATE_LIMIT="0", SIMILARITY_PRELOAD="1",
+               GRAPH_PRELOAD="1")
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn"], cwd=BACKEND_DIR, env=env)
+    try:
+        wait_until_ready(port)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(report, baseline, tolerance):
+    """Return the list of regressions of report against baseline."""
+    regressions = []
+    for name, base in baseline["endpoints"].items():
+        current = report["endpoints"].get(name)
+        if current is None:
+            continue
+        for mode in ("test_client", "http"):
+            if mode not in base or mode not in current:
+                continue
+            if current[mode]["p95_ms"] > base[mode]["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{name} [{mode}] p95 {base[mode]['p95_ms']:.2f} -> {current[mode]['p95_ms']:.2f} ms")
+            if current[mode]["throughput"] < base[mode]["throughput"] * (1 - tolerance):
+                regressions.append(f"{name} [{mode}] throughput {base[mode]['throughput']:.1f} -> {current[mode]['throughput']:.1f} req/s")
+        if "test_client" in base and "test_client" in current:
+            base_client, current_client = base["test_client"], current["test_client"]
+            # queries are deterministic, any new query is a regression
+            if current_client["queries_per_request"] > base_client["queries_per_request"] + 0.01:
+                regressions.append(f"{name} queries {base_client['queries_per_request']:.2f} -> {current_client['queries_per_request']:.2f} per request")
+            if current_client["peak_memory_kb"] > base_client["peak_memory_kb"] * (1 + tolerance):
+                regressions.append(f"{name} peak memory {base_client['peak_memory_kb']:.0f} -> {current_client['peak_memory_kb']:.0f} KB")
+    return regressions
+
+
+@click.command()
+@click.option("--rows", default=10000, help="Rows per model: 10000, 100000, 1000000...")
+@click.option("--database-url", default=None, help="Defaults to a temporary SQLite database")
+@click.option("--skip-seed", is_flag=True, help="Reuse the data already in --database-url")
+@click.option("--iterations", default=50, help="Requests per endpoint")
+@click.option("--list-iterations", default=5, help="Requests per endpoint returning whole tables")
+@click.option("--endpoint", "endpoints", multiple=True, help="Only run these endpoints (api.get_users...)")
+@click.option("--http", "use_http", is_flag=True, help="Also load the endpoints through gunicorn")
+@click.option("--http-workers", default=1)
+@click.option("--duration", default=10, help="Seconds of HTTP load per endpoint")
+@click.option("--output", default=None, help="Write the report to this JSON file")
+@click.option("--save-baseline", default=None, help="Write the report as the new baseline")
+@click.option("--check", "baseline_path", default=None, help="Fail when regressing against this baseline")
+@click.option("--tolerance", default=0.25, help="Accepted relative slowdown against the baseline")
+def main(rows, database_url, skip_seed, iterations, list_iterations, endpoints, use_http,
+         http_workers, duration, output, save_baseline, baseline_path, tolerance):
+    from app import create_app
+
+    if database_url is None:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": database_url, "STATIC_MANIFEST": False, "LOG_LEVEL": "WARNING", "RATE_LIMIT": False,
+    })
+    if not skip_seed:
+        click.echo(f"Seeding {rows} rows per model...")
+        with app.app_context():
+            seed(rows)
+
+    fixtures = Fixtures(rows)
+    report = {
+        "rows": rows,
+        "database": database_url.split(":", 1)[0],
+        "python": platform.python_version(),
+        "endpoints": {},
+        "not_covered": [],
+    }
+    routes = [(rule, method) for rule, method in api_routes(app)
+              if not endpoints or rule.endpoint in endpoints]
+    for rule, method in routes:
+        if (rule.endpoint, method) not in SCENARIOS:
+            report["not_covered"].append(f"{method} {rule.rule}")
+            continue
+        count = list_iterations if rule.endpoint in LIST_ENDPOINTS else iterations
+        result = bench_test_client(app, fixtures, rule, method, count)
+        report["endpoints"][f"{method} {rule.rule}"] = {"test_client": result}
+        click.echo(f"{method:>6} {rule.rule:<40} {result['throughput']:>9.1f} req/s  p95 {result['p95_ms']:>8.2f} ms  "
+                   f"{result['queries_per_request']:>5.1f} queries  {result['peak_memory_kb']:>9.0f} KB")
+
+    if use_http:
+        urls = app.url_map.bind("localhost")
+        with http_server(database_url, http_workers) as base_url:
+            for rule, method in routes:
+                if (rule.endpoint, method) not in SCENARIOS:
+                    continue
+                scenario = SCENARIOS[(rule.endpoint, method)]
+                headers = {"Accept-Encoding": "gzip", "Content-Type": "application/json"}
+                if method in IDEMPOTENT_METHODS:
+                    # the same request over and over, like the clients polling a page
+                    kwargs, body = scenario(fixtures)
+                    requests, repeat = [(urls.build(rule.endpoint, kwargs, method=method), body)], True
+                else:
+                    # creates and deletes can't be repeated, each request is sent once
+                    requests, repeat = [], False
+                    for _ in range(min(iterations * HTTP_WRITES_PER_ITERATION, rows // 4)):
+                        kwargs, body = scenario(fixtures)
+                        requests.append((urls.build(rule.endpoint, kwargs, method=method), body))
+                requests = [(path, json.dumps(body) if body is not None else None) for path, body in requests]
+                result = run_load(base_url, duration=duration, method=method, headers=headers,
+                                  requests=requests, repeat=repeat)
+                report["endpoints"][f"{method} {rule.rule}"]["http"] = result
+                click.echo(f"{method:>6} {rule.rule:<40} {result['throughput']:>9.1f} req/s  p95 {result['p95_ms']:>8.2f} ms  (http)")
+
+    for route in report["not_covered"]:
+        click.echo(f"Not covered by any scenario: {route}", err=True)
+
+    for path in (output, save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline["rows"] != rows:
+            raise click.ClickException(f"The baseline was recorded with {baseline['rows']} rows per model, not {rows}")
+        regressions = compare(report, baseline, tolerance)
+        for regression in regressions:
+            click.echo("REGRESSION " + regression, err=True)
+        if regressions:
+            raise click.ClickException(f"{len(regressions)} regressions against {baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
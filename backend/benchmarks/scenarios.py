@@ -0,0 +1,108 @@
+"""
+One request recipe per API endpoint. A scenario receives the Fixtures of the seeded
+database and returns the url arguments and the JSON body of the next request.
+Endpoints without a scenario are reported as not covered by the benchmarks.
+"""
+import itertools
+import random
+
+
+class Fixtures:
+    def __init__(self, rows, seed=42):
+        self.rows = rows
+        self.rand = random.Random(seed)
+        self.unique = itertools.count()
+        # deletes consume ids from the end of the tables, one per request
+        self.deletable = {}
+
+    def some_id(self):
+        # the first half of the ids is never deleted
+        return self.rand.randint(1, max(1, self.rows // 2))
+
+    def deletable_id(self, table):
+        ids = self.deletable.setdefault(table, itertools.count(self.rows, -1))
+        return next(ids)
+
+    def name(self, prefix):
+        return f"{prefix} {next(self.unique)} {self.rand.random()}"
+
+
+def _new_user(f):
+    name = f.name("bench")
+    return {}, {"name": name, "username": name, "email": name.replace(" ", "") + "@bench.com", "password": "123456"}
+
+
+def _follow_body(f):
+    follower_id = f.some_id()
+    return {}, {"follower_id": follower_id, "followed_id": (follower_id + f.rows // 4) % f.rows + 1}
+
+
+def _seeded_follow(f):
+    # the seed makes every user follow the next one (offset 1). The followers come from
+    # the half of the users that is never deleted, the purge of a deleted user would
+    # have removed the follow already and the request would only measure a 404
+    ids = f.deletable.setdefault("follows", itertools.count(max(1, f.rows // 2), -1))
+    follower_id = next(ids)
+    return {"follower_id": follower_id, "followed_id": follower_id % f.rows + 1}, None
+
+
+def _dish_body(f):
+    return {"name": f.name("dish"), "preparation_steps": "Mix everything", "flavor_profile": "salty"}
+
+
+SCENARIOS = {
+    # answers 403 without the admin token, measures the cost of the check
+    ("api.get_metrics", "GET"): lambda f: ({}, None),
+
+    ("api.get_users", "GET"): lambda f: ({}, None),
+    ("api.get_user", "GET"): lambda f: ({"user_id": f.some_id()}, None),
+    ("api.create_user", "POST"): _new_user,
+    ("api.update_user", "PUT"): lambda f: ({"user_id": f.some_id()}, {"name": f.name("user")}),
+    ("api.delete_user", "DELETE"): lambda f: ({"user_id": f.deletable_id("users")}, None),
+
+    ("api.create_follow", "POST"): _follow_body,
+    ("api.delete_follow", "DELETE"): _seeded_follow,
+    ("api.get_followers", "GET"): lambda f: ({"user_id": f.some_id()}, None),
+    ("api.get_following", "GET"): lambda f: ({"user_id": f.some_id()}, None),
+    ("api.get_mutuals", "GET"): lambda f: ({"user_id": f.some_id()}, None),
+    ("api.get_suggestions", "GET"): lambda f: ({"user_id": f.some_id()}, None),
+    ("api.get_notifications", "GET"): lambda f: ({"user_id": f.some_id()}, None),
+    ("api.get_chat_messages", "GET"): lambda f: ({"chat_id": f.some_id()}, None),
+
+    ("api.get_ingredients", "GET"): lambda f: ({}, None),
+    ("api.get_ingredient", "GET"): lambda f: ({"Ingredient_id": f.some_id()}, None),
+    ("api.create_ingredient", "POST"): lambda f: ({}, {"name": f.name("ingredient"), "type": "dish"}),
+    ("api.update_ingredient", "PUT"): lambda f: ({"Ingredient_id": f.some_id()}, {"name": f.name("ingredient")}),
+    ("api.delete_ingredient", "DELETE"): lambda f: ({"Ingredient_id": f.deletable_id("ingredients")}, None),
+
+    ("api.get_cocktails", "GET"): lambda f: ({}, None),
+    ("api.get_cocktail", "GET"): lambda f: ({"Cocktail_id": f.some_id()}, None),
+    ("api.create_cocktail", "POST"): lambda f: ({}, {
+        "name": f.name("cocktail"), "preparation_steps": "Shake with ice",
+        "flavor_profile": "sour", "user_id": f.some_id(),
+    }),
+    ("api.update_cocktail", "PUT"): lambda f: ({"Cocktail_id": f.some_id()}, {"name": f.name("cocktail")}),
+    ("api.delete_cocktail", "DELETE"): lambda f: ({"Cocktail_id": f.deletable_id("cocktails")}, None),
+    ("api.get_similar_cocktails", "GET"): lambda f: ({"Cocktail_id": f.some_id()}, None),
+
+    ("api.get_dishes", "GET"): lambda f: ({}, None),
+    ("api.get_dish", "GET"): lambda f: ({"Dish_id": f.some_id()}, None),
+    ("api.post_dish", "POST"): lambda f: ({}, _dish_body(f)),
+    ("api.update_dish", "PUT"): lambda f: ({"Dish_id": f.some_id()}, {"name": f.name("dish")}),
+    ("api.delete_dish", "DELETE"): lambda f: ({"Dish_id": f.deletable_id("dishes")}, None),
+    ("api.get_similar_dishes", "GET"): lambda f: ({"Dish_id": f.some_id()}, None),
+
+    ("api.get_favourites", "GET"): lambda f: ({}, None),
+    ("api.get_favorite", "GET"): lambda f: ({"favorite_id": f.some_id()}, None),
+    ("api.create_favorite", "POST"): lambda f: ({}, {"user_id": f.some_id(), "cocktail_id": f.some_id()}),
+    ("api.update_favorite", "PUT"): lambda f: ({"fav_id": f.some_id()}, {"dish_id": f.some_id()}),
+    ("api.delete_favorite", "DELETE"): lambda f: ({"favorite_id": f.deletable_id("favorites")}, None),
+
+    ("api.get_pairings", "GET"): lambda f: ({}, None),
+    ("api.get_pairing", "GET"): lambda f: ({"pairing_id": f.some_id()}, None),
+    ("api.create_pairing", "POST"): lambda f: ({}, {
+        "user_id": f.some_id(), "cocktail_id": f.some_id(), "dish_id": f.some_id(),
+    }),
+    ("api.update_pairing", "PUT"): lambda f: ({"pairing_id": f.some_id()}, {"dish_id": f.some_id()}),
+    ("api.delete_pairing", "DELETE"): lambda f: ({"pairing_id": f.deletable_id("pairings")}, None),
+}
@@ -0,0 +1,93 @@
+"""
+Fills a database with synthetic data for the benchmarks: `rows` rows for every model
+the API serves, inserted in bulk so that even a million rows per model seeds in minutes.
+Ids are 1..rows in every table, the scenarios rely on it.
+"""
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from api.models import db, User, Ingredient, Cocktail, Dish, Favorite, Pairing, Follow, Chat, Message, Notification
+
+CHUNK_SIZE = 10000
+# every user follows the users at these distances from its id, the negative ones follow back
+FOLLOW_OFFSETS = (-3, -2, -1, 1, 2, 3, 4, 5, 6, 7)
+FLAVORS = ('sweet', 'sour', 'bitter', 'salty', 'umami')
+NOTIFICATION_TYPES = ('comment', 'message', 'new_follower', 'other')
+WORDS = (
+    "lime", "mint", "rum", "sugar", "ice", "gin", "tonic", "orange", "bitters", "vodka",
+    "tomato", "basil", "garlic", "salmon", "rice", "lemon", "ginger", "chili", "honey", "soda",
+)
+
+
+def _text(rand, words):
+    return " ".join(rand.choice(WORDS) for _ in range(words))
+
+
+def _date(rand, days=365):
+    return datetime.now() - timedelta(seconds=rand.randint(0, days * 86400))
+
+
+def _insert(model, rows, make_row):
+    for start in range(1, rows + 1, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, rows + 1)
+        db.session.execute(model.__table__.insert(), [make_row(x) for x in range(start, stop)])
+        db.session.commit()
+
+
+def _follow(x, rows, rand):
+    # row x is a follow of the user at one of FOLLOW_OFFSETS, wrapping around the ids 1..rows
+    user_id, offset = (x - 1) // len(FOLLOW_OFFSETS) + 1, FOLLOW_OFFSETS[(x - 1) % len(FOLLOW_OFFSETS)]
+    return {"follower_id": user_id, "followed_id": (user_id - 1 + offset) % rows + 1, "date": _date(rand)}
+
+
+def seed(rows, seed=42):
+    """Create the schema and insert rows rows per model, must run inside an app context."""
+    rand = random.Random(seed)
+    # hashing is slow on purpose, every user shares the same password
+    password = generate_password_hash("123456")
+
+    db.drop_all()
+    db.create_all()
+    _insert(User, rows, lambda x: {
+        "id": x, "name": f"User {x}", "username": f"user{x}", "email": f"user{x}@test.com",
+        "password": password, "profile_info": _text(rand, 12),
+    })
+    _insert(Ingredient, rows, lambda x: {
+        "id": x, "name": f"ingredient {x}", "type": "cocktail" if x % 2 else "dish",
+    })
+    _insert(Cocktail, rows, lambda x: {
+        "id": x, "name": _text(rand, 3), "preparation_steps": _text(rand, 40),
+        "flavor_profile": rand.choice(FLAVORS), "user_id": rand.randint(1, rows),
+        "creation_date": _date(rand),
+    })
+    _insert(Dish, rows, lambda x: {
+        "id": x, "name": _text(rand, 3), "preparation_steps": _text(rand, 40),
+        "flavor_profile": rand.choice(FLAVORS), "user_id": rand.randint(1, rows),
+        "creation_date": _date(rand),
+    })
+    # half of the favorites are cocktails, the other half dishes
+    _insert(Favorite, rows, lambda x: {
+        "id": x, "user_id": x if x <= rows // 2 else x - rows // 2,
+        "cocktail_id": x if x <= rows // 2 else None,
+        "dish_id": None if x <= rows // 2 else x,
+        "saved_date": _date(rand),
+    })
+    _insert(Pairing, rows, lambda x: {
+        "id": x, "user_id": rand.randint(1, rows), "cocktail_id": rand.randint(1, rows),
+        "dish_id": rand.randint(1, rows), "saved_date": _date(rand),
+    })
+    # a year of messages and notifications, so `flask archive` has history to move
+    _insert(Chat, rows, lambda x: {"id": x, "name": f"Chat {x}", "is_group": x % 10 == 0, "creation_date": _date(rand)})
+    _insert(Message, rows, lambda x: {
+        "id": x, "chat_id": rand.randint(1, rows), "user_id": rand.randint(1, rows),
+        "content": _text(rand, 8), "sent_date": _date(rand),
+    })
+    _insert(Notification, rows, lambda x: {
+        "id": x, "user_id": rand.randint(1, rows), "type": rand.choice(NOTIFICATION_TYPES),
+        "content": _text(rand, 6), "read": rand.random() < 0.5, "date": _date(rand),
+    })
+    # followers, mutuals and two-hop suggestions for every user, wrapping around the ids
+    if rows > 2 * len(FOLLOW_OFFSETS):
+        _insert(Follow, rows * len(FOLLOW_OFFSETS), lambda x: _follow(x, rows, rand))
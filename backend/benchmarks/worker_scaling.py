@@ -0,0 +1,116 @@
+"""
+Checks that the gunicorn worker profile scales linearly: the same endpoint is loaded
+with 1, 2, 4... workers and the throughput of N workers is compared with N times
+the throughput of one.
+
+    $ python -m benchmarks.worker_scaling --workers 1 2 4 --path /api/ingredients
+
+Exits with an error when any efficiency is under --min-efficiency. Run it on a machine
+with at least as many free cores as the biggest worker count plus the load generator.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmarks.loadgen import run_load
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed_database(database_url, rows):
+    from app import create_app
+    from api.models import db, Ingredient
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": database_url, "STATIC_MANIFEST": False})
+    with app.app_context():
+        db.create_all()
+        if Ingredient.query.count() == 0:
+            db.session.add_all(
+                Ingredient(name=f"ingredient {x}", type="cocktail" if x % 2 else "dish")
+                for x in range(rows)
+            )
+            db.session.commit()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException(f"gunicorn didn't start listening on port {port}")
+
+
+def measure(workers, threads, path, duration, database_url):
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        WEB_THREADS=str(threads),
+        LOG_LEVEL="warning",
+        RATE_LIMIT="0",
+    )
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn"], cwd=BACKEND_DIR, env=env)
+    try:
+        wait_until_ready(port)
+        # enough clients to keep every thread of every worker busy
+        return run_load(
+            f"http://127.0.0.1:{port}{path}",
+            duration=duration,
+            processes=workers,
+            connections=threads * 2,
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@click.command()
+@click.option("--workers", "worker_counts", multiple=True, type=int, default=(1, 2, 4))
+@click.option("--threads", default=4, help="Threads per worker")
+@click.option("--path", default="/api/ingredients", help="Endpoint to load")
+@click.option("--duration", default=10, help="Seconds of load per worker count")
+@click.option("--rows", default=100, help="Ingredients seeded in the database")
+@click.option("--database-url", default=None, help="Defaults to a temporary SQLite database")
+@click.option("--min-efficiency", default=0.8, help="Lowest accepted fraction of linear scaling")
+def main(worker_counts, threads, path, duration, rows, database_url, min_efficiency):
+    if database_url is None:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "scaling.db")
+    seed_database(database_url, rows)
+
+    results = {}
+    for workers in sorted(worker_counts):
+        results[workers] = measure(workers, threads, path, duration, database_url)
+
+    base_workers = min(results)
+    # throughput of a single worker, extrapolated from the smallest run
+    per_worker = results[base_workers]["throughput"] / base_workers
+    failed = False
+    print(f"{'workers':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6} {'efficiency':>10}")
+    for workers, result in results.items():
+        efficiency = result["throughput"] / (per_worker * workers) if per_worker else 0.0
+        failed = failed or efficiency < min_efficiency
+        print(f"{workers:>7} {result['throughput']:>9.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f} {result['errors']:>6} {efficiency:>10.2f}")
+
+    if failed:
+        raise click.ClickException(f"Throughput scaled below {min_efficiency:.0%} of linear")
+
+
+if __name__ == "__main__":
+    main()
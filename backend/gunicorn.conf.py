@@ -0,0 +1,44 @@
+"""
+Production worker profile, run from the backend folder with:
+
+    $ gunicorn
+
+The app is built once in the master (preload_app) and forked into WEB_CONCURRENCY
+workers of WEB_THREADS threads each. create_app disposes the database pool in every
+forked worker, and sizes it to one connection per thread (see DB_POOL_SIZE and
+DB_MAX_OVERFLOW in app.py), so the database must accept at least
+WEB_CONCURRENCY * (WEB_THREADS + DB_MAX_OVERFLOW) connections.
+
+The throughput of this profile should grow linearly with the number of workers,
+check it with: $ python -m benchmarks.worker_scaling
+"""
+import multiprocessing
+import os
+
+wsgi_app = "app:create_app()"
+bind = "0.0.0.0:" + os.getenv("PORT", "3001")
+
+# workers are processes, one per core is enough as the database does the heavy work
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 4))
+# create_app reads it to size the connection pool and the concurrency cap
+os.environ["WEB_THREADS"] = str(threads)
+# connections a worker holds at once, past them they wait in the listen backlog for any
+# worker. The held ones queue for a thread; API_MAX_CONCURRENCY (by default WEB_THREADS - 1)
+# leaves one thread to answer them 503 while the others are busy, so the queue is drained
+# quickly instead of every queued request waiting for a thread and then for the database
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", threads * 8))
+
+preload_app = True
+timeout = int(os.getenv("WEB_TIMEOUT", 30))
+graceful_timeout = 30
+keepalive = 5
+# recycle workers from time to time so a leak can't grow forever. Not too often: every new
+# worker starts with cold in-memory indexes (similar items, follow graph), build them in
+# the master with SIMILARITY_PRELOAD=1 and GRAPH_PRELOAD=1 so the workers inherit them
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", 20000))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-" if os.getenv("ACCESS_LOG") == "1" else None
+loglevel = os.getenv("LOG_LEVEL", "info").lower()